@@ -0,0 +1,44 @@
+import struct
+import numpy as np
+from calplots import aocal
+
+# Calibration solutions, the binary files written by calibrate, loaded once and passed as AOCal objects between the
+# phase referencing, quality checks and plots in calibrate.py rather than each step reading the file again.
+# aocal_phaseref.run, aocal_diff.run and check_assign_solutions.check_solutions accept either a path or a loaded solution.
+
+headerFormat = '8s6I2d'
+headerIntro = b'MWAOCAL\0'
+
+
+# Reference antenna for the solutions of an observation.
+def referenceAntenna(obsid):
+    if int(obsid) > 1342950000:
+        return 8
+    elif int(obsid) > 1300000000:
+        return 0
+    else:
+        return 127
+
+
+# Return a solution, loading it from its file unless it has already been loaded.
+# With mmap the file is memory mapped copy-on-write, so only the parts used are read and changes are never written back.
+def load(solution, mmap=False):
+    if isinstance(solution, aocal.AOCal):
+        return solution
+    if not mmap:
+        return aocal.fromfile(solution)
+
+    headerSize = struct.calcsize(headerFormat)
+    with open(solution, 'rb') as f:
+        intro, fileType, structureType, nInt, nAnt, nChan, nPol, timeStart, timeEnd = struct.unpack(headerFormat, f.read(headerSize))
+    if intro != headerIntro or fileType != 0 or structureType != 0:
+        raise ValueError(f'{solution} is not a calibration solution file.')
+    data = np.memmap(solution, dtype=np.complex128, mode='c', offset=headerSize, shape=(nInt, nAnt, nChan, nPol))
+    return aocal.AOCal(data, timeStart, timeEnd)
+
+
+# Name of a solution for messages.
+def describe(solution):
+    if isinstance(solution, aocal.AOCal):
+        return f'solution {solution.shape}'
+    return str(solution)
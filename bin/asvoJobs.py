@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import random
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+# Concurrent submission of ASVO conversion jobs, used by manageReport.py download.
+# Only the submit_conversion_job_direct and get_jobs methods of the mantaray Session are used, so any object providing them can be passed in.
+# The concurrency and rate can be set with DIP_ASVO_WORKERS and DIP_ASVO_RATE (submissions per second).
+workersEnv = 'DIP_ASVO_WORKERS'
+rateEnv = 'DIP_ASVO_RATE'
+defaultWorkers = 8
+defaultRate = 5.0
+retries = 3
+backoff = 2.0
+
+# Errors where the submission never reached ASVO, so it can be retried without creating a duplicate job.
+# Submitting a job is not idempotent, after any other error the job list is checked for the job before submitting again.
+connectionErrors = (requests.ConnectionError, requests.ConnectTimeout)
+
+
+def configuredWorkers():
+    return int(os.getenv(workersEnv, defaultWorkers))
+
+def configuredRate():
+    return float(os.getenv(rateEnv, defaultRate))
+
+
+# Space out calls across all threads so no more than rate calls are started each second.
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 0 if rate <= 0 else 1 / rate
+        self.lock = threading.Lock()
+        self.next = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next)
+            self.next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+# Rejected requests, e.g. an invalid observation, which would fail again if resubmitted.
+def clientError(e):
+    response = getattr(e, 'response', None)
+    return isinstance(e, requests.HTTPError) and response is not None and response.status_code < 500
+
+# Job ID of a job in progress for the observation, from the job list, or None if there is not one.
+def findJob(session, obsid):
+    for job in session.get_jobs():
+        if str(job['row']['job_params']['obs_id']) == str(obsid) and job['row']['job_state'] not in terminalStates:
+            return job['row']['id']
+    return None
+
+
+# Submit a single job, retrying with exponential backoff and jitter.
+# Connection failures are resubmitted, after any other error the job is only resubmitted if it is not in the job list.
+# Returns (obsid, jobid, error), jobid is None if the submission failed.
+def submitJob(session, obsid, params, limiter):
+    jobParams = dict(params)
+    jobParams['obs_id'] = obsid
+    for attempt in range(retries + 1):
+        limiter.wait()
+        try:
+            jobResponse = session.submit_conversion_job_direct(jobParams)
+            return obsid, jobResponse['job_id'], None
+        except connectionErrors as e:
+            error = e
+        except Exception as e:
+            if clientError(e):
+                return obsid, None, e
+            try:
+                jobid = findJob(session, obsid)
+            except Exception:
+                return obsid, None, e
+            if jobid is not None:
+                return obsid, jobid, None
+            error = e
+        if attempt == retries:
+            return obsid, None, error
+        time.sleep(backoff * 2 ** attempt * (0.5 + random.random()))
+
+
+# Submit jobs for the observations in order until maxJobs have been submitted or the observations run out.
+# Failed submissions are replaced by the next observations in the list.
+# Returns the results of each submission attempted, [(obsid, jobid, error)], in the order of obsids.
+def submitJobs(session, obsids, params, maxJobs, workers=None, rate=None):
+    if workers is None:
+        workers = configuredWorkers()
+    if rate is None:
+        rate = configuredRate()
+    limiter = RateLimiter(rate)
+
+    results = []
+    remaining = list(obsids)
+    submitted = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        while submitted < maxJobs and len(remaining) > 0:
+            batch = remaining[:maxJobs - submitted]
+            remaining = remaining[len(batch):]
+            for result in pool.map(lambda obsid: submitJob(session, obsid, params, limiter), batch):
+                results.append(result)
+                if result[1] is not None:
+                    submitted += 1
+    return results
+
+
+# Local cache of the ASVO job states, {jobid: {obsid, state, lastSeen, lastChanged}}, stored next to the report.
+# It is used to skip downloading the job list when no jobs can have changed and to record when each job last changed.
+terminalStates = ('completed', 'error', 'cancelled', 'expired')
+# Report job statuses of observations with no job in progress.
+settledStatuses = ('Downloaded', 'Purged', 'Missing Data', 'Download Error', 'error', 'cancelled', 'expired')
+# Download the job list at least this often, in seconds, to pick up jobs submitted outside of DIP.
+cacheMaxAge = 6 * 3600
+
+
+def cacheFile(reportFile):
+    return os.path.splitext(reportFile.rstrip(os.sep))[0] + '.asvo_jobs.json'
+
+def readCache(reportFile):
+    file = cacheFile(reportFile)
+    if os.path.exists(file):
+        try:
+            with open(file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+    return dict(lastSync=0, jobs={})
+
+def writeCache(reportFile, cache):
+    file = cacheFile(reportFile)
+    with open(file + '.tmp', 'w') as f:
+        json.dump(cache, f)
+    os.replace(file + '.tmp', file)
+
+# Record newly submitted jobs so the next sync knows they are in progress.
+def addJobs(cache, jobs):
+    now = time.time()
+    for obsid, jobid in jobs:
+        cache['jobs'][str(jobid)] = dict(obsid=str(obsid), state='queued', lastSeen=now, lastChanged=now)
+
+
+# The job list only needs to be downloaded if a job is in progress, according to the report or the cache, or the cache is old.
+def needsSync(cache, jobStatuses):
+    if time.time() - cache['lastSync'] > cacheMaxAge:
+        return True
+    if any(job['state'] not in terminalStates for job in cache['jobs'].values()):
+        return True
+    pending = jobStatuses.dropna()
+    return bool((~pending.isin(settledStatuses + ('',))).any())
+
+# Download the job list and update the cache.
+# Returns the jobs as [(obsid, jobid, state)] in the order of the job list.
+def syncJobs(session, cache):
+    now = time.time()
+    jobs = []
+    for job in session.get_jobs():
+        obsid = job['row']['job_params']['obs_id']
+        jobid = job['row']['id']
+        state = job['row']['job_state']
+        cached = cache['jobs'].setdefault(str(jobid), dict(obsid=str(obsid), state=None, lastChanged=now))
+        if cached['state'] != state:
+            cached['state'] = state
+            cached['lastChanged'] = now
+        cached['lastSeen'] = now
+        jobs.append((obsid, jobid, state))
+    # Forget jobs which are no longer listed, e.g. expired jobs removed by ASVO.
+    cache['jobs'] = {jobid: job for jobid, job in cache['jobs'].items() if job['lastSeen'] == now}
+    cache['lastSync'] = now
+    return jobs
@@ -4,8 +4,14 @@ from enum import Flag
 import os
 import sys
 import wget
+import atexit
 import report
+import aoSolution
+import resources
 import flagTiles
+import stageTiming
+import deferredPlots
+import skyModelCache
 import subprocess
 import gleamx.crop_catalogue as cc
 import gleamx.vo2model as vo2m
@@ -16,7 +22,7 @@ import gleamx.check_assign_solutions as checkSolutions
 import gleamx.ms_flag_by_uvdist as flagUV
 
 from astropy.io import fits
-from calplots import aocal, aocal_plot
+from calplots import aocal_plot
 
 
 if len(sys.argv) != 4:
@@ -27,26 +33,34 @@ projectdir = sys.argv[1]
 obsid = sys.argv[2]
 reportCsv = sys.argv[3]
 
+# Collect the report updates for the stage and write them when the script exits, including on failure or SIGTERM,
+# and at the milestones of the stage so the progress is kept if the task is killed.
+# The stage timing and resource usage is added to the updates just before they are written at exit.
+obsReport = report.transaction(reportCsv, obsid)
+atexit.register(obsReport.commit)
+report.commitOnTerminate()
+stageTimer = stageTiming.StageTimer('calibration')
+atexit.register(lambda: obsReport.updateMany(stageTimer.stop()))
+
 # Define relavant file names and paths.
 metafits = obsid + '.metafits'
 catGGSM = os.path.join(projectdir, 'models/GGSM_updated.fits')
+modelCache = os.path.join(projectdir, 'models/cache')
 catCropped = obsid + '_cropped_catalogue.fits'
 calibrationModel = obsid + '_local_gleam_model.txt'
 measurementSet = obsid + '.ms'
 
+# Limit the threads of the tools without a thread option, e.g. flagantennae and applysolutions, to the allocated cores.
+resources.limitThreads()
+
 # Set reference antenna.
-if int(obsid) > 1342950000:
-    refant = 8
-elif int(obsid) > 1300000000:
-    refant = 0
-else:
-    refant = 127
+refant = aoSolution.referenceAntenna(obsid)
 
 # Calibration Shell
 def calibrate(localMeasurementSet, solution, ts=None):
     # Processing options.
-    cores = 48  # Number of cores to use.
-    mem   = 50  # Amount of memory to use.
+    cores = resources.availableCores()      # Number of cores to use.
+    mem   = resources.availableMemory()     # Amount of memory to use in GB.
     minuv = 75  # Minimum baseline of 75 lambda (=250m at 88 MHz) for calibration.
 
     minuvm = 234 * minuv / int(metadata['CENTCHAN'])
@@ -88,18 +102,35 @@ metaHdu.close()
 knownBadTiles = flagTiles.findBadTiles(obsid, projectdir)
 if len(knownBadTiles) > 0:
     subprocess.run(f'flagantennae {measurementSet} {knownBadTiles}', shell=True, check=True)
-    report.updateObs(reportCsv, obsid, 'flagged', knownBadTiles)
+    obsReport.update('flagged', knownBadTiles)
+    obsReport.commit()
 
 # If more than 50 bad tiles, fail the processing,
 if knownBadTiles.count(' ') >= 49:
-    report.updateObs(reportCsv, obsid, 'calibration', 'Fail - Too Many Bad Tiles.')
-    report.updateObs(reportCsv, obsid, 'status', 'Failed')
+    obsReport.update('calibration', 'Fail - Too Many Bad Tiles.')
+    obsReport.update('status', 'Failed')
+    obsReport.commit()
     exit(-1)
 
 
 # Crop the GGSM catalogue to the 250 brightest sources near the pointing location and bulld the calibration model from them.
-cc.run(ra=metadata['RA'], dec=metadata['DEC'], radius=30, top_bright=250, metafits=metafits, cat=catGGSM, fluxcol='S_200', plotFile=obsid + '_local_gleam_model.png', output=catCropped)
-vo2m.run(catalogue=catCropped, point=True, output=calibrationModel, racol='RAJ2000', decol='DEJ2000', acol='a', bcol='b', pacol='pa', fluxcol='S_200', alphacol='alpha')
+# Models are shared between observations with the same pointing and frequency, reuse one if it has already been built.
+modelKey = skyModelCache.cacheKey(metadata, radius=30, topBright=250, catalogue=catGGSM)
+modelPlot = obsid + '_local_gleam_model.png'
+modelFiles = {'model.txt': calibrationModel, 'cropped_catalogue.fits': catCropped}
+# The plots of the model are cached with it, or their sidecars when plotting is deferred, so every observation has them.
+for plotSuffix in ['', '-top-brightest']:
+    plotFile = obsid + '_local_gleam_model' + plotSuffix + '.png'
+    if deferredPlots.enabled():
+        modelFiles['model' + plotSuffix + deferredPlots.sidecarSuffix] = deferredPlots.sidecarFile(plotFile)
+    else:
+        modelFiles['model' + plotSuffix + '.png'] = plotFile
+if skyModelCache.fetch(modelCache, modelKey, modelFiles):
+    print(f'Using the cached calibration model {modelKey}.')
+else:
+    cc.run(ra=metadata['RA'], dec=metadata['DEC'], radius=30, top_bright=250, metafits=metafits, cat=catGGSM, fluxcol='S_200', plotFile=modelPlot, output=catCropped)
+    vo2m.run(catalogue=catCropped, point=True, output=calibrationModel, racol='RAJ2000', decol='DEJ2000', acol='a', bcol='b', pacol='pa', fluxcol='S_200', alphacol='alpha')
+    skyModelCache.store(modelCache, modelKey, modelFiles)
 
 
 # Ionospheric triage.
@@ -107,10 +138,11 @@ ts = 10  # Interval for ionospheric triage (in time steps).
 solution = obsid + '_local_gleam_model_solutions_ts' + str(ts) + '.bin'
 calibrate(measurementSet, solution, ts)
 #aocal_plot(solution, refant)
+# The solution is loaded once and shared by the plots and the ionospheric diagnostics.
 plotFilename = solution[:-4]
-ao = aocal.fromfile(solution)
+ao = aoSolution.load(solution, mmap=True)
 aocal_plot.plot(ao, plotFilename, refant=refant, amp_max=2, testTiles=False)
-aocal_diff.run(solution, obsid, metafits=metafits, refant=refant)
+aocal_diff.run(ao, obsid, metafits=metafits, refant=refant)
 
 
 # Assume the ionosphere is ok and derive a calibration solution.
@@ -119,16 +151,17 @@ solutionRef = obsid + '_local_gleam_model_solutions_initial_ref.bin'
 calibrate(measurementSet, solution)
 # Create a version divided through by the reference antenna, so that all observations have the same relative XY phase, allowing polarisation calibration solutions to be transferred.
 # This also sets the cross-terms to zero by default.
-aocal_phaseref.run(solution, solutionRef, refant, xy=-2.806338586067941065e+01, dxy=-4.426533296449057023e-07, ms=measurementSet)
+# The referenced solution is written for applysolutions and returned for the plots and quality checks, so neither reads it again.
+ao = aocal_phaseref.run(solution, solutionRef, refant, xy=-2.806338586067941065e+01, dxy=-4.426533296449057023e-07, ms=measurementSet)
 #aocal_plot(solutionRef, refant)
 plotFilename = solutionRef[:-4]
-ao = aocal.fromfile(solutionRef)
 badTiles = aocal_plot.plot(ao, plotFilename, refant=refant, amp_max=2)
 
 # Report all tiles flagged.
 badTilesStr = ' '.join(map(str, badTiles))
 allBadTiles = f'{badTilesStr} {knownBadTiles}'
-report.updateObs(reportCsv, obsid, 'flagged', allBadTiles.strip())
+obsReport.update('flagged', allBadTiles.strip())
+obsReport.commit()
 
 # Flag any bad tiles detected.
 if len(badTiles) > 0:
@@ -139,18 +172,18 @@ if len(badTiles) > 0:
     
     # Recalibrate
     calibrate(measurementSet, solution)
-    aocal_phaseref.run(solution, solutionRef, refant, xy=-2.806338586067941065e+01, dxy=-4.426533296449057023e-07, ms=measurementSet)
+    ao = aocal_phaseref.run(solution, solutionRef, refant, xy=-2.806338586067941065e+01, dxy=-4.426533296449057023e-07, ms=measurementSet)
     plotFilename = solutionRef[:-4] + '_recal'
-    ao = aocal.fromfile(solutionRef)
     badTiles = aocal_plot.plot(ao, plotFilename, refant=refant, amp_max=2)
 
 
 # Test to see if the calibration solution meets minimum quality control. This is a simple check based on the number of flagged solutions.
-if not checkSolutions.check_solutions(aofile=solutionRef):
+if not checkSolutions.check_solutions(aofile=ao):
     print('Solution Failed') 
     subprocess.run('mv "' + solutionRef + '" "' + obsid + '_local_gleam_model_solutions_initial_ref_failed.bin"', shell=True)
-    report.updateObs(reportCsv, obsid, 'calibration', 'Fail - Solution does not meet min quality.')
-    report.updateObs(reportCsv, obsid, 'status', 'Failed')
+    obsReport.update('calibration', 'Fail - Solution does not meet min quality.')
+    obsReport.update('status', 'Failed')
+    obsReport.commit()
     exit(-1)
 
 # Apply the solution
@@ -159,4 +192,4 @@ subprocess.run(f'applysolutions -nocopy "{measurementSet}" "{solutionRef}"', she
 # Flag by UV dist.
 flagUV.run(measurementSet, 'DATA', apply=True)
 
-report.updateObs(reportCsv, obsid, 'calibration', 'Success')
\ No newline at end of file
+obsReport.update('calibration', 'Success')
\ No newline at end of file
@@ -4,6 +4,7 @@ import pandas as pd
 import astropy.units as u
 from astropy.io import fits
 from astropy.coordinates import SkyCoord
+import catalogueIndex
 
 
 
@@ -66,9 +67,9 @@ def reduceCat(inCat, outCat, distance=0.05):
     catHdu = fits.open(inCat)
     catData = catHdu[1].data
 
-    cat = SkyCoord(ra=catData['ra']*u.degree, dec=catData['dec']*u.degree)  
-    idx, d2d, d3d = cat.match_to_catalog_sky(cat, nthneighbor=2)
-    reducedCat = catData[d2d > distance*u.degree]
+    cat = catalogueIndex.CatalogueIndex(catData['ra'], catData['dec'])
+    idx, d2d = cat.nearest(cat.ra, cat.dec, nthneighbor=2)
+    reducedCat = catData[d2d > distance]
     print(f'Reduced catalogue from {len(cat)} sources to {len(reducedCat)} sources.')
 
     print(f'Writting: {outCat}')
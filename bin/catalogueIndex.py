@@ -0,0 +1,97 @@
+import os
+import pickle
+import numpy as np
+import astropy.units as u
+from astropy.io import fits
+from astropy.coordinates import SkyCoord
+from scipy.spatial import cKDTree
+
+# Spatial index of catalogue positions for cone and nearest neighbour queries, used by crop_catalogue,
+# generate_ateam_subtract_model, measureRatio and catCalcs.
+# Positions are held as unit vectors in a KD-tree, the tree returns the candidates and the separations are then
+# calculated with astropy so the results match a full separation against every row.
+# Indexes of catalogue files are cached in <catalogue>.index, the positions as .npy (memory mapped when loaded)
+# and the tree pickled, keyed on the size and modification time of the catalogue.
+
+
+# Unit vectors for positions in degrees.
+def unitVectors(ra, dec):
+    ra = np.radians(np.asarray(ra, dtype=np.float64))
+    dec = np.radians(np.asarray(dec, dtype=np.float64))
+    return np.stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)], axis=-1)
+
+# Straight line distance between unit vectors separated by an angle in degrees.
+def chordLength(angle):
+    return 2 * np.sin(np.radians(np.minimum(angle, 180)) / 2)
+
+
+class CatalogueIndex:
+    def __init__(self, ra, dec, tree=None):
+        self.ra = np.asarray(ra, dtype=np.float64)
+        self.dec = np.asarray(dec, dtype=np.float64)
+        if tree is None:
+            tree = cKDTree(unitVectors(self.ra, self.dec))
+        self.tree = tree
+
+    def __len__(self):
+        return len(self.ra)
+
+    def coords(self, indices=slice(None)):
+        return SkyCoord(self.ra[indices], self.dec[indices], unit=(u.deg, u.deg))
+
+    # Indices, in ascending order, of the sources within radius degrees of a position.
+    def cone(self, ra, dec, radius):
+        # Search slightly wider than the radius so no source is lost to rounding, the exact separation decides.
+        candidates = np.array(sorted(self.tree.query_ball_point(unitVectors(ra, dec), chordLength(radius) * (1 + 1e-9) + 1e-12)), dtype=int)
+        if len(candidates) == 0:
+            return candidates
+        separations = SkyCoord(ra, dec, unit=(u.deg, u.deg)).separation(self.coords(candidates)).deg
+        return candidates[separations < radius]
+
+    # Index of, and separation in degrees to, the nth nearest source to each position.
+    def nearest(self, ra, dec, nthneighbor=1):
+        distances, indices = self.tree.query(unitVectors(ra, dec), k=nthneighbor)
+        if nthneighbor > 1:
+            indices = indices[..., nthneighbor - 1]
+        separations = SkyCoord(ra, dec, unit=(u.deg, u.deg)).separation(self.coords(indices)).deg
+        return indices, separations
+
+
+# Load the index of a FITS catalogue, from the cache if the catalogue has not changed since it was built.
+def load(catalogue, racol='RAJ2000', decol='DEJ2000'):
+    stat = os.stat(catalogue)
+    cacheDir = catalogue + '.index'
+    key = f'{racol}_{decol}_{stat.st_size}_{stat.st_mtime_ns}'
+    positionsFile = os.path.join(cacheDir, key + '.npy')
+    treeFile = os.path.join(cacheDir, key + '.tree')
+
+    if os.path.exists(positionsFile) and os.path.exists(treeFile):
+        try:
+            positions = np.load(positionsFile, mmap_mode='r')
+            with open(treeFile, 'rb') as f:
+                tree = pickle.load(f)
+            return CatalogueIndex(positions[0], positions[1], tree)
+        except (OSError, ValueError, pickle.UnpicklingError):
+            pass
+
+    with fits.open(catalogue, memmap=True) as hdu:
+        positions = np.array([hdu[1].data[racol], hdu[1].data[decol]], dtype=np.float64)
+    index = CatalogueIndex(positions[0], positions[1])
+
+    # Write the cache, replacing any index of an older version of the catalogue.
+    # Tasks building the same index at the same time each write to their own file and rename it into place.
+    try:
+        os.makedirs(cacheDir, exist_ok=True)
+        for name in os.listdir(cacheDir):
+            if not name.startswith(key):
+                os.remove(os.path.join(cacheDir, name))
+        tmpSuffix = f'.{os.getpid()}.tmp'
+        with open(positionsFile + tmpSuffix, 'wb') as f:
+            np.save(f, positions)
+        with open(treeFile + tmpSuffix, 'wb') as f:
+            pickle.dump(index.tree, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(positionsFile + tmpSuffix, positionsFile)
+        os.replace(treeFile + tmpSuffix, treeFile)
+    except OSError:
+        print(f'Unable to cache the index of {catalogue}.')
+    return index
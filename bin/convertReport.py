@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+
+import sys
+import report
+
+
+# Convert a report between the CSV, SQLite and sharded formats, the format is taken from the file extension.
+# e.g. convertReport.py dip_report.csv dip_report.db to import, convertReport.py dip_report.db dip_report.csv to export.
+# A destination ending in .shards is split into one report per night, or per obsid range if a range size is given,
+# e.g. convertReport.py dip_report.csv dip_report.shards 100000
+if not (len(sys.argv) == 3 or len(sys.argv) == 4):
+    print('ERROR: Incorrect number of parameters.')
+    exit(-1)
+
+srcFile = sys.argv[1]
+dstFile = sys.argv[2]
+
+shardConfig = None
+if len(sys.argv) == 4:
+    if sys.argv[3] == 'night':
+        shardConfig = dict(scheme='night')
+    elif sys.argv[3].isnumeric():
+        shardConfig = dict(scheme='range', rangeSize=int(sys.argv[3]))
+    else:
+        print('ERROR: Shard scheme must be night or an obsid range size.')
+        exit(-1)
+
+count = report.convertReport(srcFile, dstFile, shardConfig)
+print(f'Converted {count} observations from {srcFile} to {dstFile}.')
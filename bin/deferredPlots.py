@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import importlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+# Deferred rendering of the diagnostic plots, taking matplotlib off the critical path of the processing tasks.
+# With DIP_DEFER_PLOTS set (deferPlots in nextflow.config) the data for each plot is saved to a small .plot.npz sidecar
+# next to where the PNG would be written, along with the "module:function" that draws it, and nothing imports matplotlib.
+# Usage: deferredPlots.py path [path ...] renders the sidecars under each path at low priority and removes them.
+
+sidecarSuffix = '.plot.npz'
+workers = 4
+
+
+def enabled():
+    return os.environ.get('DIP_DEFER_PLOTS', '').lower() in ('1', 'true', 'yes')
+
+def sidecarFile(plotFile):
+    return os.path.splitext(plotFile)[0] + sidecarSuffix
+
+
+def resolve(renderer):
+    module, function = renderer.split(':')
+    return getattr(importlib.import_module(module), function)
+
+# Draw the plot now, or save the data to draw it later if plotting is deferred.
+# The renderer is called as function(plotFile, **data), the data must be numbers, strings or arrays of them.
+def plot(plotFile, renderer, **data):
+    if not enabled():
+        return resolve(renderer)(plotFile, **data)
+    np.savez_compressed(sidecarFile(plotFile), renderer=renderer, plotFile=os.path.basename(plotFile), **data)
+
+
+# Draw the plot saved in a sidecar, next to the sidecar, and remove the sidecar.
+# The plot is named after the sidecar, so a sidecar copied under another name (e.g. from the sky model cache) draws its own plot.
+def render(sidecar):
+    with np.load(sidecar, allow_pickle=False) as f:
+        data = {name: f[name].item() if f[name].ndim == 0 else f[name] for name in f.files}
+    renderer = data.pop('renderer')
+    plotFile = sidecar[:-len(sidecarSuffix)] + os.path.splitext(data.pop('plotFile'))[1]
+    resolve(renderer)(plotFile, **data)
+    os.remove(sidecar)
+
+def findSidecars(paths):
+    sidecars = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                sidecars += [os.path.join(root, name) for name in files if name.endswith(sidecarSuffix)]
+        elif path.endswith(sidecarSuffix):
+            sidecars.append(path)
+    return sorted(sidecars)
+
+def renderSafely(sidecar):
+    try:
+        render(sidecar)
+        return None
+    except Exception as e:
+        return f'{sidecar}: {e}'
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('ERROR: Incorrect number of parameters.')
+        exit(-1)
+
+    os.nice(19)
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    sidecars = findSidecars(sys.argv[1:])
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        errors = [error for error in pool.map(renderSafely, sidecars) if error is not None]
+    for error in errors:
+        print(f'Unable to render {error}')
+    print(f'Rendered {len(sidecars) - len(errors)} of {len(sidecars)} plots.')
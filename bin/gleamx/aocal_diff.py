@@ -8,13 +8,18 @@ import os, sys
 
 import numpy as np
 import math
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from matplotlib.offsetbox import AnchoredText
+from concurrent.futures import ProcessPoolExecutor
 
 from astropy.io import fits
-from calplots import aocal
+import aoSolution
+import deferredPlots
+
+def pyplot():
+    """Import pyplot when a plot is drawn, so nothing imports matplotlib when plotting is deferred"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
 
 def get_tile_info(metafits):
     hdus = fits.open(metafits)
@@ -26,121 +31,113 @@ def get_tile_info(metafits):
     East = tiles["East"]
     return Names, North, East
 
+def solution_intervals(ao, refant):
+    """First and last intervals where the reference antenna has a solution"""
+    non_nan_intervals = np.flatnonzero(~np.isnan(ao[:, refant, :, 0]).all(axis=1))
+    return non_nan_intervals.min(), non_nan_intervals.max()
+
 def diff(ao, metafits, refant):
-    diffs = []
-    non_nan_intervals = np.where([not np.isnan(ao[i, refant, :, 0]).all() for i in range(ao.n_int)])[0]
-    t_start = non_nan_intervals.min()
-    t_end = non_nan_intervals.max()
-    
-    # Divide through by refant
-    ao = ao / ao[:, refant, :, :][:, np.newaxis, :, :]
-    ant_iter = np.arange(ao.n_ant)
-    for a, antenna in enumerate(ant_iter):
-        temp = []
-        # Only XX and YY
-        for pol in 0, 3:
-            # Difference the complex gains, then convert to angles
-           temp.append(np.angle(ao[t_end, antenna, :, pol] / ao[t_start, antenna, :, pol], deg=True))
-        diffs.append(temp)
-    return diffs
+    """Phase change in degrees between the first and last intervals, relative to the reference antenna,
+    as an (antenna, pol, channel) array for XX and YY"""
+    t_start, t_end = solution_intervals(ao, refant)
+
+    # Divide the two intervals through by refant, only XX and YY
+    start = ao[t_start, :, :, 0::3] / ao[t_start, refant, :, 0::3]
+    end = ao[t_end, :, :, 0::3] / ao[t_end, refant, :, 0::3]
+
+    # Difference the complex gains, then convert to angles
+    diffs = np.angle(end / start, deg=True)
+    return np.asarray(diffs).transpose(0, 2, 1)
 
 def phi_rms(ao, metafits, refant):
-    phi_rmss = []
-    non_nan_intervals = np.where([not np.isnan(ao[i, refant, :, 0]).all() for i in range(ao.n_int)])[0]
-    t_start = non_nan_intervals.min()
-    t_end = non_nan_intervals.max()
-    # Calculate middle interval
-    t_mid = int((t_end - t_start)/2.0)
-    print(t_mid)
-
-    # Divide through by refant
+    """Standard deviation over time of the phase in degrees, relative to the reference antenna,
+    as an (antenna x pol, channel) array for XX and YY"""
+    # Divide through by refant, only XX and YY
     # (Probably unnecessary)
-    ao = ao / ao[:, refant, :, :][:, np.newaxis, :, :]
-    ant_iter = np.arange(ao.n_ant)
-    for a, antenna in enumerate(ant_iter):
-        temp = []
-        # Only XX and YY
-        for pol in 0, 3:
-            # Difference the complex gains
-            # Divide all gains by t_mid value so central phase is zero (solves wrapping problem)
-           temp_gains = ao[:, antenna, :, pol] / ao[t_mid, antenna, :, pol]
-            
-            # then convert to angles
-           temp_angles = np.angle(ao[:, antenna, :, pol], deg=True)
-            
-            # Then find RMS -- over time axis only
-           phi_rmss.append(np.std(temp_angles, axis=0))
-        #    print(np.std(ao[:, antenna, :, pol], axis=0))
-           print(temp_angles.shape)
-           print(np.std(temp_angles, axis=0).shape)
-    return phi_rmss
+    ao = ao[..., 0::3] / ao[:, refant, np.newaxis, :, 0::3]
 
-def histo_diffs(diffs, obsid, outdir):
+    # Then find RMS -- over time axis only
+    phi_rmss = np.std(np.angle(ao, deg=True), axis=0)
+    return np.asarray(phi_rmss).transpose(0, 2, 1).reshape(-1, phi_rmss.shape[1])
+
+def histogram_stats(values, **kwargs):
+    """Histogram of ``values`` with their median, peak (the left edge of the fullest bin) and standard deviation"""
+    n, bins = np.histogram(values, bins = 60, **kwargs)
+    peak = bins[np.where(n == n.max())][0]
+    return n, bins, np.median(values), peak, np.std(values)
+
+def render_histogram(plot_file, n, bins, median, peak, text):
+    from matplotlib.offsetbox import AnchoredText
+    plt = pyplot()
     fig = plt.figure()
     ax = fig.add_subplot(111)
-    n, bins, patches = ax.hist(diffs, bins = 60, range=[-180, 180])
-    peak = bins[np.where(n == n.max())][0]
-    ax.axvline(x=np.median(diffs), color="red")
+    ax.hist(bins[:-1], bins = bins, weights = n)
+    ax.axvline(x=median, color="red")
     ax.axvline(x=peak, color="orange")
     ax.set_xlabel("Phase change / degrees")
-    at = AnchoredText("Median: {0:3.0f}deg\nPeak: {1:3.0f}deg\nStdev: {2:3.0f}deg".format(np.median(diffs), peak, np.std(diffs)),
+    at = AnchoredText(text,
                   prop=dict(size=8), frameon=True,
                   loc=1,
                   )
     at.patch.set_boxstyle("round,pad=0.,rounding_size=0.2")
     ax.add_artist(at)
+    fig.savefig(plot_file)
+    plt.close(fig)
+
+def histo_diffs(diffs, obsid, outdir):
+    n, bins, median, peak, std = histogram_stats(diffs, range=[-180, 180])
+    text = "Median: {0:3.0f}deg\nPeak: {1:3.0f}deg\nStdev: {2:3.0f}deg".format(median, peak, std)
     outname = obsid+"_histogram.png"
-    fig.savefig(os.path.join(outdir, outname))
+    deferredPlots.plot(os.path.join(outdir, outname), "gleamx.aocal_diff:render_histogram", n=n, bins=bins, median=median, peak=peak, text=text)
 
-    return np.median(diffs), peak, np.std(diffs)
+    return median, peak, std
 
 def histo_rmss(rmss, obsid, outdir):
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
-    n, bins, patches = ax.hist(rmss, bins = 60) #, range=[0, 1.0])
-    peak = bins[np.where(n == n.max())][0]
-    ax.axvline(x=np.median(rmss), color="red")
-    ax.axvline(x=peak, color="orange")
-    ax.set_xlabel("Phase change / degrees")
-#    at = AnchoredText("Median: {0:3.3f}deg\nPeak: {1:3.3f}deg\nStdev: {2:3.3f}deg".format(np.median(rmss), peak, np.std(rmss)),
-    at = AnchoredText("Median: {0}deg\nPeak: {1}deg\nStdev: {2}deg".format(np.median(rmss), peak, np.std(rmss)),
-                  prop=dict(size=8), frameon=True,
-                  loc=1,
-                  )
-    at.patch.set_boxstyle("round,pad=0.,rounding_size=0.2")
-    ax.add_artist(at)
+    n, bins, median, peak, std = histogram_stats(rmss) #, range=[0, 1.0])
+#    text = "Median: {0:3.3f}deg\nPeak: {1:3.3f}deg\nStdev: {2:3.3f}deg".format(median, peak, std)
+    text = "Median: {0}deg\nPeak: {1}deg\nStdev: {2}deg".format(median, peak, std)
     outname = obsid+"_rms_histogram.png"
-    fig.savefig(os.path.join(outdir, outname))
+    deferredPlots.plot(os.path.join(outdir, outname), "gleamx.aocal_diff:render_histogram", n=n, bins=bins, median=median, peak=peak, text=text)
 
-    return np.median(rmss), peak, np.std(rmss)
+    return median, peak, std
 
-def phase_map(diffs, metafits, names, obsid, outdir):
+def render_phase_map(plot_file, diffs, tile_names, north, east, names):
+    plt = pyplot()
     fig = plt.figure(figsize = (10,8))
-    Names, North, East = get_tile_info(metafits)
     ax = fig.add_axes([0.15, 0.1, 0.65, 0.75])
     ax.axis("equal")
-    sc = ax.scatter(North, East, marker='o', s=150, linewidths=4, c=diffs, cmap='hsv', vmin = -180., vmax = 180.)
+    sc = ax.scatter(north, east, marker='o', s=150, linewidths=4, c=diffs, cmap='hsv', vmin = -180., vmax = 180.)
     ax.set_xlabel("East / m")
     ax.set_ylabel("North / m")
     if names is True:
-        for i, txt in enumerate(Names):
-            ax.annotate(txt, (North[i], East[i]))
+        for i, txt in enumerate(tile_names):
+            ax.annotate(txt, (north[i], east[i]))
 
     cbaxes = fig.add_axes([0.82, 0.1, 0.02, 0.75])
     cb = plt.colorbar(sc, cax = cbaxes, orientation="vertical")
     cb.set_label('Phase change / degrees')
+    fig.savefig(plot_file)
+    plt.close(fig)
+
+def phase_map(diffs, metafits, names, obsid, outdir):
+    Names, North, East = get_tile_info(metafits)
     outname = obsid+"_phasemap.png"
-    fig.savefig(os.path.join(outdir, outname))
-    
-def phase_wrt_East(diffs, metafits, names, obsid, outdir):
+    deferredPlots.plot(os.path.join(outdir, outname), "gleamx.aocal_diff:render_phase_map", diffs=diffs, tile_names=np.asarray(Names, dtype=str), north=North, east=East, names=names)
+
+def render_phase_wrt_East(plot_file, diffs, east):
+    plt = pyplot()
     fig = plt.figure(figsize = (10,8))
-    Names, North, East = get_tile_info(metafits)
     ax = fig.add_subplot(111)
-    sc = ax.scatter(East, diffs, marker='o')
+    sc = ax.scatter(east, diffs, marker='o')
     ax.set_xlabel("East / m")
     ax.set_ylabel("diffs / degrees")
+    fig.savefig(plot_file)
+    plt.close(fig)
+
+def phase_wrt_East(diffs, metafits, names, obsid, outdir):
+    Names, North, East = get_tile_info(metafits)
     outname = obsid+"_wrt_East.png"
-    fig.savefig(os.path.join(outdir, outname))
+    deferredPlots.plot(os.path.join(outdir, outname), "gleamx.aocal_diff:render_phase_wrt_East", diffs=diffs, east=East)
 
 def csv_out(obsid, median, peak, std, outdir):
     outformat = "{0},{1},{2},{3}\n"
@@ -155,16 +152,16 @@ def csv_out(obsid, median, peak, std, outdir):
 def run(filename, obsid, metafits=None, refant=127, outdir='.', names=True, rms=False):
 
     
-    if os.path.exists(filename):
-        ao = aocal.fromfile(filename)
-    else:
+    # filename can also be an already loaded solution.
+    if isinstance(filename, str) and not os.path.exists(filename):
         print(filename+" does not exist!")
         sys.exit(1)
+    ao = aoSolution.load(filename)
 
-    diffs = np.array(diff(ao, metafits, refant))
+    diffs = diff(ao, metafits, refant)
     
     # Flatten array and delete NaNs for histogram
-    median, peak, std = histo_diffs(diffs[np.logical_not(np.isnan(diffs))].flatten(), obsid, outdir)
+    median, peak, std = histo_diffs(diffs[np.logical_not(np.isnan(diffs))], obsid, outdir)
     csv_out(obsid, median, peak, std, outdir)
 
     if metafits is not None:
@@ -177,5 +174,43 @@ def run(filename, obsid, metafits=None, refant=127, outdir='.', names=True, rms=
             phase_wrt_East(diffs, metafits, names, obsid, outdir)
     # New option: plot RMS
     if rms is True:
-        rmss = np.array(phi_rms(ao, metafits, refant))
-        median, peak, std = histo_rmss(rmss[np.logical_not(np.isnan(rmss))].flatten(), obsid, outdir)
+        rmss = phi_rms(ao, metafits, refant)
+        median, peak, std = histo_rmss(rmss[np.logical_not(np.isnan(rmss))], obsid, outdir)
+
+
+def solution_stats(filename, refant, rms=False):
+    """Phase change statistics (median, peak, std) of a solutions file, followed by those of the RMS with ``rms``"""
+    ao = aoSolution.load(filename, mmap=True)
+    diffs = diff(ao, None, refant)
+    stats = histogram_stats(diffs[np.logical_not(np.isnan(diffs))], range=[-180, 180])[2:]
+    if rms is True:
+        rmss = phi_rms(ao, None, refant)
+        stats += histogram_stats(rmss[np.logical_not(np.isnan(rmss))])[2:]
+    return stats
+
+def batch(solutions, outputfile, rms=False, workers=None):
+    """Calculate the statistics of many solutions files in parallel and write them to one table
+
+    Args:
+        solutions (list): (obsid, solutions file, reference antenna) of each observation
+        outputfile (str): csv file to write, with the columns of the _ionodiff.csv files
+
+    Keyword Args:
+        rms (bool): also calculate the statistics of the phase RMS (default: False)
+        workers (int): number of processes (default: number of cores)
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(solution_stats, filename, refant, rms) for obsid, filename, refant in solutions]
+
+        columns = ["obsid", "median", "peak", "std"]
+        if rms is True:
+            columns += ["rms_median", "rms_peak", "rms_std"]
+        with open(outputfile, 'w') as output_file:
+            output_file.write("#" + ",".join(columns) + "\n")
+            for (obsid, filename, refant), future in zip(solutions, futures):
+                try:
+                    stats = future.result()
+                except Exception as e:
+                    print("Unable to calculate the statistics of {0}: {1}".format(filename, e))
+                    continue
+                output_file.write(",".join(str(value) for value in (obsid,) + tuple(stats)) + "\n")
@@ -2,11 +2,13 @@
 from __future__ import print_function
 
 import os, logging
-from calplots.aocal import fromfile
 import numpy as np
+import aoSolution
 from pyrap import tables
 
 
+# infilename is the path of the solution or the already loaded solution, which is left unchanged.
+# The phase referenced solution is written to outfilename and returned.
 def run(infilename, outfilename, refant, xy=0.0, dxy=0.0, ms=None, store_true=False, verbose=0, incremental=None, preserve_xterms=None, no_preserve_mask=False):
 
     if verbose == 1:
@@ -17,7 +19,8 @@ def run(infilename, outfilename, refant, xy=0.0, dxy=0.0, ms=None, store_true=Fa
         print("XY phase cannot be set if preserving xterms")
         exit(-1)
 
-    ao = fromfile(infilename)
+    initial_ao = aoSolution.load(infilename)
+    ao = initial_ao
 
     ref_phasor = (ao[0, refant, ...] / np.abs(ao[0, refant, ...]))[
         np.newaxis, np.newaxis, ...
@@ -56,7 +59,8 @@ def run(infilename, outfilename, refant, xy=0.0, dxy=0.0, ms=None, store_true=Fa
 
     if not no_preserve_mask:
         print("Carrying forward NaN mask")
-        initial_ao = fromfile(infilename)
         ao[np.isnan(initial_ao)] = np.nan
 
     ao.tofile(outfilename)
+
+    return ao
@@ -20,7 +20,7 @@ import logging
 
 import numpy as np
 
-from calplots.aocal import fromfile
+import aoSolution
 
 
 logger = logging.getLogger(__name__)
@@ -124,7 +124,7 @@ def check_solutions(
     """Inspects the ao-calibrate solutions file to evaluate its reliability
 
     Args:
-        aofile (str): aocal solutions file to inspect
+        aofile (str|AOCal): aocal solutions file to inspect, or the already loaded solutions
     
     Keyword Args:
         threshold (float): The threshold, between 0 to 1, where too many solutions are flagged before the file becomes invalid (default: 0.25)
@@ -139,12 +139,12 @@ def check_solutions(
     threshold = threshold / 100 if threshold > 1 else threshold
     logger.debug(f"Threshold level set is {threshold=}")
 
-    if not os.path.exists(aofile):
+    if isinstance(aofile, str) and not os.path.exists(aofile):
         logger.debug(f"{aofile} not found")
         return False
 
-    logger.debug(f"Loading {aofile=}")
-    ao_results = fromfile(aofile)
+    logger.debug(f"Loading {aoSolution.describe(aofile)}")
+    ao_results = aoSolution.load(aofile)
 
     no_chan = ao_results.n_chan
     no_ant = ao_results.n_ant
@@ -307,8 +307,8 @@ def run(mode, aofile=None, threshold=0.25, segments=None, segment_threshold=None
         logger.setLevel(logging.DEBUG)
 
     if mode == "subbands":
-        logger.debug(f"Loading solutions file {aofile}")
-        ao_results = fromfile(aofile)
+        logger.debug(f"Loading solutions file {aoSolution.describe(aofile)}")
+        ao_results = aoSolution.load(aofile)
     
         derive_edge_channel_flagged(
             ao_results,
@@ -331,10 +331,10 @@ def run(mode, aofile=None, threshold=0.25, segments=None, segment_threshold=None
             no_sub_bands=no_subbands
 
         ):
-            print(f"{aofile} passed")
+            print(f"{aoSolution.describe(aofile)} passed")
             return 'pass'
         else:
-            print(f"{aofile} failed")
+            print(f"{aoSolution.describe(aofile)} failed")
             return 'fail'
 
     elif mode == "assign":
@@ -1,9 +1,4 @@
 #!/usr/bin/env python
-import matplotlib as mpl
-
-#mpl.use("Agg")  # So does not use display
-import matplotlib.pyplot as plt
-
 import sys
 from astropy.coordinates import SkyCoord
 import astropy.units as u
@@ -13,6 +8,18 @@ from astropy.io import fits
 #from argparse import ArgumentParser
 
 from gleamx.beam_value_at_radec import beam_value, parse_metafits
+import catalogueIndex
+import deferredPlots
+
+
+def pyplot():
+    """Import pyplot when a plot is drawn, so nothing imports matplotlib when plotting is deferred"""
+    import matplotlib as mpl
+
+    #mpl.use("Agg")  # So does not use display
+    import matplotlib.pyplot as plt
+
+    return plt
 
 
 def flux_cut(sources, min_flux):
@@ -44,16 +51,22 @@ def top_brightest(sources, top_n, plot=None):
         parts = plot.split(".")
         plot = f"{'.'.join(parts[:-1])}-top-brightest.{parts[-1]}"
 
-        fig, ax = plt.subplots(1, 1)
+        deferredPlots.plot(plot, "gleamx.crop_catalogue:render_top_brightest", sorted_sources=sources[sort_idx], top_n=top_n)
 
-        ax.plot(np.arange(len(sources)), sources[sort_idx], "ro")
-        ax.axvline(top_n)
+    return sort_idx[:top_n]
 
-        ax.set(title=f"{top_n} of {len(sources)} selected", xscale="log")
 
-        fig.savefig(plot)
+def render_top_brightest(plot, sorted_sources, top_n):
+    plt = pyplot()
+    fig, ax = plt.subplots(1, 1)
 
-    return sort_idx[:top_n]
+    ax.plot(np.arange(len(sorted_sources)), sorted_sources, "ro")
+    ax.axvline(top_n)
+
+    ax.set(title=f"{top_n} of {len(sorted_sources)} selected", xscale="log")
+
+    fig.savefig(plot)
+    plt.close(fig)
 
 
 def percentile_total(sources, percentile, plot=None):
@@ -81,20 +94,27 @@ def percentile_total(sources, percentile, plot=None):
         parts = plot.split(".")
         plot = f"{'.'.join(parts[:-1])}-percentile-total.{parts[-1]}"
 
-        fig, ax = plt.subplots(1, 1)
+        title = f"{np.sum(mask)} of {len(sources)} selected, percentile {percentile}, cumulative flux {cumulative[-1]:.0f}Jy"
+        deferredPlots.plot(plot, "gleamx.crop_catalogue:render_percentile_total", cumulative_perc=cumulative_perc, first_false=first_false, title=title)
 
-        ax.plot(np.arange(len(sources)), cumulative_perc, "ro")
-        # ax.plot(np.arange(len(sources)), cumulative, "ro")
-        ax.axvline(first_false)
+    return sort_idx[mask]
 
-        ax.set(
-            title=f"{np.sum(mask)} of {len(sources)} selected, percentile {percentile}, cumulative flux {cumulative[-1]:.0f}Jy",
-            # xscale="log",
-        )
 
-        fig.savefig(plot)
+def render_percentile_total(plot, cumulative_perc, first_false, title):
+    plt = pyplot()
+    fig, ax = plt.subplots(1, 1)
 
-    return sort_idx[mask]
+    ax.plot(np.arange(len(cumulative_perc)), cumulative_perc, "ro")
+    # ax.plot(np.arange(len(sources)), cumulative, "ro")
+    ax.axvline(first_false)
+
+    ax.set(
+        title=title,
+        # xscale="log",
+    )
+
+    fig.savefig(plot)
+    plt.close(fig)
 
 
 def unwrap(RA):
@@ -213,19 +233,13 @@ def unwrap(RA):
 #     args = parser.parse_args()
 
 def run(ra, dec, radius, top_bright, metafits, cat, plotFile, output='cropped_catalogue.fits', fluxcol='int_flux_wide', racol='RAJ2000', decol='DEJ2000', alphacol='alpha', minflux=None, beamselect=True, attenuate=False, percentile_total=None):
-    vunwrap = np.vectorize(unwrap)
-
-    pos = SkyCoord(ra, dec, unit=(u.deg, u.deg))
-
     # Read in the catalogue
     temp = fits.open(cat)
     data = temp[1].data
 
-    coords = SkyCoord(data[racol], data[decol], unit=(u.deg, u.deg))
-    separations = np.array(pos.separation(coords))
-
-    # Select sources within crop radius of your original RA and Dec
-    indices = np.where(separations < radius)
+    # Select sources within crop radius of your original RA and Dec, using the cached spatial index of the catalogue
+    index = catalogueIndex.load(cat, racol=racol, decol=decol)
+    indices = index.cone(float(ra), float(dec), radius)
 
     # Select only sources which meet the minimum flux density criterion
     if minflux is not None:
@@ -306,12 +320,12 @@ def run(ra, dec, radius, top_bright, metafits, cat, plotFile, output='cropped_ca
         print("No sources selected!")
 
     if plotFile is not None:
-        srcs = coords[indices]
+        srcs = index.coords(indices)
 
         minra = np.nanmin(srcs.fk5.ra.value)
         maxra = np.nanmax(srcs.fk5.ra.value)
         if maxra - minra > 300.0:
-            ra = vunwrap(srcs.fk5.ra.value)
+            ra = np.where(srcs.fk5.ra.value > 180.0, srcs.fk5.ra.value - 360.0, srcs.fk5.ra.value)
         else:
             ra = srcs.fk5.ra.value
         dec = srcs.fk5.dec.value
@@ -320,45 +334,51 @@ def run(ra, dec, radius, top_bright, metafits, cat, plotFile, output='cropped_ca
         fluxd = data[fluxcol][indices]
         alpha = data[alphacol][indices]
 
-        # Use the source flux density to specify the plotting order (fainter things later)
-        order = np.argsort(-1 * fluxd)
-
-        # Plot the sources: sources with spectral indices as coloured circles, those without as markers
-        bright = np.logical_not(np.isnan(alpha))
-        dim = np.isnan(alpha)
-
-        # Create a figure in WCS coordinates
-        fig = plt.figure(figsize=(6, 6))
-        ax = fig.add_axes([0.1, 0.1, 0.7, 0.7])
-        points = ax.scatter(
-            ra[order][bright],
-            dec[order][bright],
-            c=alpha[order],
-            s=20 * fluxd[order] * np.log10(1000 * fluxd[order]),
-            marker="o",
-            cmap="inferno",
-            vmin=-1.4,
-            vmax=0.3,
-        )
-        ax.scatter(
-            ra[order][dim], dec[order][dim], marker="x", color="red"
-        )  # transform = ax.get_transform("fk5")
-
-        # Add a colorbar for the alpha values
-        cbaxes_alpha = fig.add_axes([0.83, 0.1, 0.02, 0.7])
-        cb_alpha = plt.colorbar(points, cax=cbaxes_alpha, orientation="vertical")
-        cb_alpha.set_label("Spectral index (alpha)")
-
-        # Reverse x-axis
-        xlims = ax.get_xlim()
-        ax.set_xlim(xlims[1], xlims[0])
-
-        # axis labels
-        ax.set_xlabel("Right Ascension (deg)")
-        ax.set_ylabel("Declination (deg)")
-
-        # Title
-        ax.set_title("Observation {0}".format(metafits[0:10]))
-
-        fig.savefig(plotFile, bbox_inches="tight")
-
+        deferredPlots.plot(plotFile, "gleamx.crop_catalogue:render_sky_model", ra=ra, dec=dec, fluxd=fluxd, alpha=alpha, title="Observation {0}".format(metafits[0:10]))
+
+
+def render_sky_model(plotFile, ra, dec, fluxd, alpha, title):
+    plt = pyplot()
+
+    # Use the source flux density to specify the plotting order (fainter things later)
+    order = np.argsort(-1 * fluxd)
+
+    # Plot the sources: sources with spectral indices as coloured circles, those without as markers
+    bright = np.logical_not(np.isnan(alpha))
+    dim = np.isnan(alpha)
+
+    # Create a figure in WCS coordinates
+    fig = plt.figure(figsize=(6, 6))
+    ax = fig.add_axes([0.1, 0.1, 0.7, 0.7])
+    points = ax.scatter(
+        ra[order][bright],
+        dec[order][bright],
+        c=alpha[order],
+        s=20 * fluxd[order] * np.log10(1000 * fluxd[order]),
+        marker="o",
+        cmap="inferno",
+        vmin=-1.4,
+        vmax=0.3,
+    )
+    ax.scatter(
+        ra[order][dim], dec[order][dim], marker="x", color="red"
+    )  # transform = ax.get_transform("fk5")
+
+    # Add a colorbar for the alpha values
+    cbaxes_alpha = fig.add_axes([0.83, 0.1, 0.02, 0.7])
+    cb_alpha = plt.colorbar(points, cax=cbaxes_alpha, orientation="vertical")
+    cb_alpha.set_label("Spectral index (alpha)")
+
+    # Reverse x-axis
+    xlims = ax.get_xlim()
+    ax.set_xlim(xlims[1], xlims[0])
+
+    # axis labels
+    ax.set_xlabel("Right Ascension (deg)")
+    ax.set_ylabel("Declination (deg)")
+
+    # Title
+    ax.set_title(title)
+
+    fig.savefig(plotFile, bbox_inches="tight")
+    plt.close(fig)
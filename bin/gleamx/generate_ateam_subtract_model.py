@@ -16,6 +16,7 @@ from astropy.table import Table
 from mwa_pb_lookup.lookup_beam import beam_lookup_1d as gleamx_beam_lookup
 from gleamx.beam_value_at_radec import parse_metafits, beam_value
 from gleamx.check_src_fov import check_coords
+import catalogueIndex
 
 # TODO: Move to a proper GLEAM-X location
 # MWA location from CONV2UVFITS/convutils.h
@@ -144,7 +145,7 @@ def ggsm_row_model(row):
     return out
 
 
-def search_ggsm(a_src, ggsm_sky, search_radius):
+def search_ggsm(a_src, ggsm_sky, search_radius, index=None):
     """Search for components around a A-team source and return a mask of components
     that are within a specified search_radius
 
@@ -153,10 +154,17 @@ def search_ggsm(a_src, ggsm_sky, search_radius):
         ggsm_sky (SkyCoord): Component positions from the GGSM
         search_radius (units): The search radius to use
 
+    Keyword Args:
+        index (catalogueIndex.CatalogueIndex): Spatial index of ggsm_sky, used to avoid a separation against every component (default: None)
+
     Returns:
         np.ndarray: Boolean mask describing whether GSSM components were near a source position
     """
-    mask = a_src.separation(ggsm_sky) < search_radius
+    if index is None:
+        return a_src.separation(ggsm_sky) < search_radius
+
+    mask = np.zeros(len(ggsm_sky), dtype=bool)
+    mask[index.cone(a_src.ra.deg, a_src.dec.deg, search_radius.to(u.deg).value)] = True
 
     return mask
 
@@ -446,6 +454,7 @@ def ateam_model_creation(
         ggsm_sky = SkyCoord(
             ggsm_tab["RAJ2000"], ggsm_tab["DEJ2000"], unit=(u.deg, u.deg)
         )
+        ggsm_index = catalogueIndex.load(ggsm)
     elif mode == "casa":
         model_text = ""
     elif mode in ("casaclean", "wsclean"):
@@ -488,7 +497,7 @@ def ateam_model_creation(
         elif mode == "count":
             no_comps += 1
         elif mode == "subtrmodel":
-            matches = search_ggsm(src.pos, ggsm_sky, search_radius)
+            matches = search_ggsm(src.pos, ggsm_sky, search_radius, index=ggsm_index)
             comps = ggsm_tab[matches]
             no_comps += len(comps)
 
@@ -14,6 +14,7 @@ import numpy as np
 import sys
 import warnings
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from casacore.tables import table, taql, maketabdesc, makescacoldesc
 
@@ -43,30 +44,20 @@ class MeasurementSet:
         antenna_table = table(self.name + "/ANTENNA", readonly=True, ack=False)
         self.antennas = list(set(mset.getcol("ANTENNA1")))
         self.nbaselines = int(len(self.antennas) * (len(self.antennas) - 1) / 2)
-        self.baselines = []
         self.station_names = {}
         self.baseline_stats = np.full((self.nbaselines, 5), 1.0, dtype=np.float32)
-        i = 0
-        for ant1 in self.antennas:
-            for ant2 in self.antennas:
-                baseline = set([ant1, ant2])
-                if ant1 != ant2 and baseline not in self.baselines:
 
-                    self.baselines.append(baseline)
-                    self.baseline_stats[i, 0] = ant1
-                    self.baseline_stats[i, 1] = ant2
+        # Each pair of antennas once, in the order of the antenna list.
+        first, second = np.triu_indices(len(self.antennas), k=1)
+        antennas = np.array(self.antennas, dtype=int)
+        ant1, ant2 = antennas[first], antennas[second]
+        self.baselines = [set(baseline) for baseline in zip(ant1, ant2)]
+        self.baseline_stats[:, 0] = ant1
+        self.baseline_stats[:, 1] = ant2
 
-                    # get baseline length:
-                    ant1_pos = antenna_table.getcol("POSITION", startrow=ant1, nrow=1)[
-                        0
-                    ]
-                    ant2_pos = antenna_table.getcol("POSITION", startrow=ant2, nrow=1)[
-                        0
-                    ]
-
-                    self.baseline_stats[i, 2] = cartesian_dist3d(ant1_pos, ant2_pos)
-
-                    i += 1
+        # get baseline length:
+        positions = antenna_table.getcol("POSITION")
+        self.baseline_stats[:, 2] = cartesian_dist3d(positions[ant1].T, positions[ant2].T)
 
         # Get station names as well:
         station_names = antenna_table.getcol("NAME")
@@ -76,30 +67,80 @@ class MeasurementSet:
         self.baseline_stats = self.baseline_stats[self.baseline_stats[:, 2].argsort()]
 
     @staticmethod
-    def get_data(mset):
+    def get_data(mset, startrow=0, nrow=-1):
 
-        flags = mset.filtered.getcol("FLAG")
-        data = mset.filtered.getcol(mset.data_column)
+        flags = mset.filtered.getcol("FLAG", startrow=startrow, nrow=nrow)
+        data = mset.filtered.getcol(mset.data_column, startrow=startrow, nrow=nrow)
         data[flags] = np.nan
 
         return data
 
+    def block_rows(self, memory):
+        """Number of rows to read at a time to keep the visibilities held in memory under
+        ``memory`` bytes: the block being averaged, its temporary copies and the next block."""
+        cell = self.filtered.getcell(self.data_column, 0)
+        row_bytes = cell.size * (cell.itemsize + 1)
+
+        return max(1, int(memory // (4 * row_bytes)))
+
+    def iter_data(self, nrow):
+        """Yield ``(startrow, data)`` for each block of ``nrow`` rows, with flagged visibilities
+        set to NaN. The next block is read in a background thread while the caller processes
+        the current one."""
+
+        nrows = self.filtered.nrows()
+        if nrows == 0:
+            return
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            future = pool.submit(MeasurementSet.get_data, self, 0, nrow)
+            for start in range(0, nrows, nrow):
+                data = future.result()
+                if start + nrow < nrows:
+                    future = pool.submit(MeasurementSet.get_data, self, start + nrow, nrow)
+                yield start, data
+
     @staticmethod
-    def flag_baselines(ms, baselines):
-        """example taql expressions:
-        SELECT FROM some.ms WHERE any(ANTENNA1==[0,0,1] && ANTENNA2==[1,3,2])
-        update MY.MS set FLAG_ROW=T where isdefined(FLAG) && all(FLAG)
+    def flag_baselines(ms, baselines, count=True, nrow=10000):
+        """Flag the rows of ``baselines``, (ANTENNA1, ANTENNA2) pairs, setting FLAG_ROW and FLAG
+        together in a single pass over just those rows.
+
+        The rows are selected in memory from the antenna columns, rather than by a TaQL
+        expression evaluated against every row, and FLAG is written ``nrow`` rows at a time.
+        With ``count`` the number of visibilities flagged is counted from the flags of the
+        selected rows as they are overwritten, instead of scanning the whole table twice.
         """
 
         ant1, ant2 = zip(*baselines)
-        unflag1 = taql("CALC sum([select nfalse(FLAG) from $ms])")
-
         print("Flagging {} baselines.".format(len(ant1)))
-        taql("update $ms set FLAG_ROW=T where any(ANTENNA1==$ant1 && ANTENNA2==$ant2)")
-        taql("update $ms set FLAG=T where any(ANTENNA1==$ant1 && ANTENNA2==$ant2)")
 
-        unflag2 = taql("CALC sum([select nfalse(FLAG) from $ms])")
-        print("Number of visibilities flagged: {}".format(unflag1[0] - unflag2[0]))
+        mset = table(ms, readonly=False, ack=False)
+        ms_ant1 = mset.getcol("ANTENNA1").astype(np.intp)
+        ms_ant2 = mset.getcol("ANTENNA2").astype(np.intp)
+        nant = max(ms_ant1.max(), ms_ant2.max(), max(ant1), max(ant2)) + 1
+        flag_pairs = np.zeros(nant * nant, dtype=bool)
+        flag_pairs[np.array(ant1) * nant + np.array(ant2)] = True
+        rows = np.flatnonzero(flag_pairs[ms_ant1 * nant + ms_ant2])
+
+        flagged = 0
+        if len(rows) > 0:
+            selection = mset.selectrows(rows)
+            cell_shape = selection.getcell("FLAG", 0).shape
+            for start in range(0, len(rows), nrow):
+                n = min(nrow, len(rows) - start)
+                if count:
+                    flagged += np.count_nonzero(
+                        ~selection.getcol("FLAG", startrow=start, nrow=n)
+                    )
+                selection.putcol(
+                    "FLAG", np.ones((n,) + cell_shape, dtype=bool), startrow=start, nrow=n
+                )
+            selection.putcol("FLAG_ROW", np.ones(len(rows), dtype=bool))
+            selection.close()
+        mset.close()
+
+        if count:
+            print("Number of visibilities flagged: {}".format(flagged))
 
 
 def cartesian_dist3d(c1, c2):
@@ -107,25 +148,135 @@ def cartesian_dist3d(c1, c2):
     return np.sqrt((c2[0] - c1[0]) ** 2 + (c2[1] - c1[1]) ** 2 + (c2[2] - c1[2]) ** 2)
 
 
-def chan_avg(mset, data_column="CORRECTED_DATA", stride=1000):
+def group_sum(values, groups, ngroups):
+    """Sum the rows of ``values`` in each of ``ngroups`` groups.
+
+    The rows are added in order, as ``np.sum`` does for the rows of a single group, so the
+    sums are the same as summing each group separately.
+
+    Args:
+        values (numpy.ndarray): real or complex values, one row per sample
+        groups (numpy.ndarray): group of each row
+        ngroups (int): number of groups
+    """
+    if np.iscomplexobj(values):
+        sums = np.empty((ngroups, values.shape[1]), dtype=np.complex128)
+        sums.real = group_sum(values.real, groups, ngroups)
+        sums.imag = group_sum(values.imag, groups, ngroups)
+        return sums
+
+    sums = np.zeros((ngroups, values.shape[1]), dtype=np.float64)
+    for pol in range(values.shape[1]):
+        sums[:, pol] = np.bincount(groups, weights=values[:, pol], minlength=ngroups)
+    return sums
+
+
+def group_nanmean_nanstd(values, groups, ngroups):
+    """``np.nanmean`` and ``np.nanstd`` along the rows of each group of ``values``.
+
+    Follows the same steps as numpy so the results are identical to calling them per group.
+    Groups without any valid values are NaN.
+
+    Args:
+        values (numpy.ndarray): real or complex values, one row per sample
+        groups (numpy.ndarray): group of each row
+        ngroups (int): number of groups
     """
+    mask = np.isnan(values)
+    values = np.where(mask, 0, values)
+    count = group_sum((~mask).astype(np.float64), groups, ngroups).astype(np.intp)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        avg = np.true_divide(group_sum(values, groups, ngroups), count)
+
+        deviation = values - avg[groups]
+        deviation[mask] = 0
+        sqr = np.multiply(deviation, deviation.conj()).real
+        std = np.sqrt(np.true_divide(group_sum(sqr, groups, ngroups), count))
+
+    return avg, std
+
+
+def window_outliers(dist, baseline_avg, window, sigma, tolerance=1e-3):
+    """Find the baselines whose average differs from the average of the baselines within
+    ``window`` of their length by more than ``sigma`` standard deviations.
+
+    The baselines are sorted by length, so each window is a contiguous range found with
+    ``np.searchsorted`` and its statistics come from prefix sums. Baselines within
+    ``tolerance`` of the threshold are checked again with ``np.nanmean`` and ``np.nanstd`` of
+    the window so the result is the same as calculating every window directly.
+
+    Args:
+        dist (numpy.ndarray): sorted baseline lengths
+        baseline_avg (numpy.ndarray): average of each baseline, one column per polarisation
+        window (float): half width of the window in metres
+        sigma (float): threshold in standard deviations
+
+    Keyword Args:
+        tolerance (float): relative distance from the threshold to check directly (default: 1e-3)
+    """
+    lower = np.searchsorted(dist, dist - window, side="right")
+    upper = np.searchsorted(dist, dist + window, side="left")
+
+    # Offset the values by their mean to keep the sums of squares well conditioned.
+    values = baseline_avg.astype(np.float64)
+    valid = ~np.isnan(values)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        offset = np.nan_to_num(np.nanmean(values, axis=0))
+    shifted = np.where(valid, values - offset, 0.0)
+
+    def prefix(x):
+        return np.concatenate([np.zeros((1, x.shape[1])), np.cumsum(x, axis=0)])
+
+    count = prefix(valid.astype(np.float64))
+    sum1 = prefix(shifted)
+    sum2 = prefix(shifted ** 2)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        n = count[upper] - count[lower]
+        mean = (sum1[upper] - sum1[lower]) / n
+        std = np.sqrt(np.maximum((sum2[upper] - sum2[lower]) / n - mean ** 2, 0))
+
+        margin = np.abs(values - offset - mean) - sigma * std
+        scale = np.abs(values) + np.abs(mean + offset) + sigma * std
+        outliers = (margin > 0).any(axis=1)
+        close = (np.abs(margin) <= tolerance * scale).any(axis=1)
+
+    for i in np.flatnonzero(close):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+
+            window_std = np.nanstd(baseline_avg[lower[i] : upper[i]], axis=0)
+            window_avg = np.nanmean(baseline_avg[lower[i] : upper[i]], axis=0)
+
+            outliers[i] = (np.abs(baseline_avg[i] - window_avg) > sigma * window_std).any()
+
+    return outliers
+
+
+def chan_avg(mset, data_column="CORRECTED_DATA", stride=None, memory=1024 ** 3):
+    """Mean visibility across channels for each row and polarisation.
+
+    The visibilities are streamed from the measurement set in blocks of ``stride`` rows, by
+    default as many rows as fit in ``memory`` bytes, so the memory used does not depend on the
+    size of the measurement set.
     """
 
-    data = MeasurementSet.get_data(mset)
     data_avg_amp = np.full((mset.filtered.nrows(), 4), np.nan, dtype=np.complex_)
+    if mset.filtered.nrows() == 0:
+        return data_avg_amp
+
+    if stride is None:
+        stride = mset.block_rows(memory)
 
     # Hides empty slice warnings when channel already completely flagged
     with warnings.catch_warnings():
         warnings.simplefilter("ignore", category=RuntimeWarning)
 
-        # read in data in chunks to help with memory (for my laptop mostly):
-        for i in range(0, mset.filtered.nrows(), stride):
-            if i + stride > mset.filtered.nrows():
-                end = mset.filtered.nrows()
-            else:
-                end = i + stride
+        for start, data in mset.iter_data(stride):
             # mean visibility across channels for each row/pol:
-            data_avg_amp[i:end, :] = np.nanmean(data[i:end, :, :], axis=1)
+            data_avg_amp[start : start + len(data), :] = np.nanmean(data, axis=1)
 
     return data_avg_amp
 
@@ -144,52 +295,38 @@ def get_baseline_stats(
     baseline_avg = np.full((len(mset.baseline_stats), 4), np.nan, dtype=np.float32)
     baseline_std = np.full((len(mset.baseline_stats), 4), np.nan, dtype=np.float32)
 
-    for i in range(len(mset.baseline_stats)):
-
-        a1 = mset.baseline_stats[i, 0]
-        a2 = mset.baseline_stats[i, 1]
+    # Index of the baseline of each row, rows of baselines not in baseline_stats are dropped.
+    nbaselines = len(mset.baseline_stats)
+    stats_ant1 = mset.baseline_stats[:, 0].astype(np.intp)
+    stats_ant2 = mset.baseline_stats[:, 1].astype(np.intp)
+    nant = int(max(ant1.max(), ant2.max(), stats_ant1.max(), stats_ant2.max())) + 1
+    lookup = np.full(nant * nant, nbaselines, dtype=np.intp)
+    lookup[stats_ant1 * nant + stats_ant2] = np.arange(nbaselines)
+    rows = lookup[ant1.astype(np.intp) * nant + ant2.astype(np.intp)]
+    selected = rows < nbaselines
 
-        d = data_avg_amp[(ant1 == int(a1)) & (ant2 == int(a2))]
+    # abs for the complex vis? np.std does this as well internally
+    d = data_avg_amp[selected]
+    baseline_avg[:], _ = group_nanmean_nanstd(np.abs(d), rows[selected], nbaselines)
+    _, baseline_std[:] = group_nanmean_nanstd(d, rows[selected], nbaselines)
 
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", category=RuntimeWarning)
-
-            # abs for the complex vis? np.std does this as well internally
-            avg = np.nanmean(np.abs(d), axis=0)
-            std = np.nanstd(d, axis=0)
-
-        baseline_avg[i, :] = avg
-        baseline_std[i, :] = std
+    outliers = window_outliers(mset.baseline_stats[:, 2], baseline_avg, window, sigma)
 
     count = 0
     flag_string = ""
     baselines = []
-    for i in range(len(mset.baseline_stats)):
-
-        dist = mset.baseline_stats[i, 2]
-
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", category=RuntimeWarning)
-
-            window_selection = (mset.baseline_stats[:, 2] < dist + window) & (
-                mset.baseline_stats[:, 2] > dist - window
-            )
-
-            window_std = np.nanstd(baseline_avg[window_selection], axis=0)
-            window_avg = np.nanmean(baseline_avg[window_selection], axis=0)
-
-            if (np.abs(baseline_avg[i] - window_avg) > sigma * window_std).any():
-                # output suitable to pass to CASA's flagdata:
-                flag_string += ";{}&{}".format(
-                    mset.station_names[int(mset.baseline_stats[i, 0])],
-                    mset.station_names[int(mset.baseline_stats[i, 1])],
-                )
+    for i in np.flatnonzero(outliers):
+        # output suitable to pass to CASA's flagdata:
+        flag_string += ";{}&{}".format(
+            mset.station_names[int(mset.baseline_stats[i, 0])],
+            mset.station_names[int(mset.baseline_stats[i, 1])],
+        )
 
-                baselines.append(
-                    (int(mset.baseline_stats[i, 0]), int(mset.baseline_stats[i, 1]))
-                )
+        baselines.append(
+            (int(mset.baseline_stats[i, 0]), int(mset.baseline_stats[i, 1]))
+        )
 
-                count += 1
+        count += 1
 
     if not return_baselines:
         flag_string = flag_string.lstrip(";")
@@ -198,9 +335,9 @@ def get_baseline_stats(
         return baselines
 
 
-def run(ms, column, sigma=3, window=5000, apply=False):
+def run(ms, column, sigma=3, window=5000, apply=False, memory=1024 ** 3):
     mset = MeasurementSet(ms, column)
-    d = chan_avg(mset, column, stride=50000)
+    d = chan_avg(mset, column, memory=memory)
     if apply:
         baselines = get_baseline_stats(
             mset, d, window=window, sigma=sigma, return_baselines=True
@@ -73,10 +73,19 @@ def run(catalogue, output='test.txt', namecol='Name', racol='ra_str', decol='dec
             indices = np.where(np.isnan(data[acol]))
         shape[indices] = "point"
 
+    # Convert all of the coordinates to sexagesimal strings in one pass.
+    if rastr is True:
+        coords = SkyCoord(np.asarray(data[racol]), np.asarray(data[decol]), frame="fk5", unit=(u.hour, u.deg))
+    else:
+        coords = SkyCoord(np.asarray(data[racol]), np.asarray(data[decol]), frame="fk5", unit=(u.deg, u.deg))
+
+    ras = coords.ra.to_string(u.hour)
+    decs = coords.dec.to_string(u.deg)
+
     bigzip = zip(
         names,
-        data[racol],
-        data[decol],
+        ras,
+        decs,
         data[acol],
         data[bcol],
         data[pacol],
@@ -86,20 +95,14 @@ def run(catalogue, output='test.txt', namecol='Name', racol='ra_str', decol='dec
         shape,
     )
 
+    # Write the sources in chunks rather than one component at a time.
+    chunk = []
     with open(output, "w") as f:
         f.write("skymodel fileformat 1.1\n")
         for Name, RA, Dec, a, b, pa, flux, alpha, beta, shape in bigzip:
 
-            if rastr is True:
-                coords = SkyCoord(RA, Dec, frame="fk5", unit=(u.hour, u.deg))
-            else:
-                coords = SkyCoord(RA, Dec, frame="fk5", unit=(u.deg, u.deg))
-
-            RA = coords.ra.to_string(u.hour)
-            Dec = coords.dec.to_string(u.deg)
-
             if shape == "gaussian":
-                f.write(
+                chunk.append(
                     gformatter.format(
                         Name=Name,
                         RA=RA,
@@ -116,7 +119,7 @@ def run(catalogue, output='test.txt', namecol='Name', racol='ra_str', decol='dec
                 )
 
             elif shape == "point":
-                f.write(
+                chunk.append(
                     pformatter.format(
                         Name=Name,
                         RA=RA,
@@ -129,3 +132,7 @@ def run(catalogue, output='test.txt', namecol='Name', racol='ra_str', decol='dec
                     )
                 )
 
+            if len(chunk) >= 1000:
+                f.write("".join(chunk))
+                chunk = []
+        f.write("".join(chunk))
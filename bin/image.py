@@ -2,7 +2,10 @@
 
 import os
 import sys
+import atexit
 import report
+import resources
+import stageTiming
 import subprocess
 
 from astropy.io import fits
@@ -18,6 +21,15 @@ robust = sys.argv[3]
 tukey = sys.argv[4]
 reportCsv = sys.argv[5]
 
+# Collect the report updates for the stage and write them when the script exits, including on failure or SIGTERM,
+# and at the milestones of the stage so the progress is kept if the task is killed.
+# The stage timing and resource usage is added to the updates just before they are written at exit.
+obsReport = report.transaction(reportCsv, obsid)
+atexit.register(obsReport.commit)
+report.commitOnTerminate()
+stageTimer = stageTiming.StageTimer('image')
+atexit.register(lambda: obsReport.updateMany(stageTimer.stop()))
+
 # Define relavant file names and paths.
 metafits = obsid + '.metafits'
 measurementSet = obsid + '.ms'
@@ -29,6 +41,8 @@ nmitter = 10
 basescale=0.6
 imsize=10000
 chans = 4
+cores = resources.limitThreads()      # Cores and memory (GB) allocated to the task.
+mem = resources.availableMemory()
 mgain = 0.75
 
 
@@ -45,7 +59,8 @@ scale = round(scale, 8)
 # Clean the two main linear polizations.
 cleanCmd = f'''wsclean \
     -gridder wgridder \
-    -abs-mem 100 \
+    -j {cores} \
+    -abs-mem {mem} \
     -multiscale \
     -mgain {mgain} \
     -multiscale-gain 0.15 \
@@ -70,4 +85,4 @@ cleanCmd = f'''wsclean \
 print(cleanCmd)
 subprocess.run(cleanCmd, shell=True, check=True)
 
-report.updateObs(reportCsv, obsid, 'image', 'Success')
+obsReport.update('image', 'Success')
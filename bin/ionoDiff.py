@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import aoSolution
+import resources
+import gleamx.aocal_diff as aocal_diff
+
+# Ionospheric phase change statistics of many observations, calculated in parallel and written to one table
+# rather than an _ionodiff.csv per observation.
+# Usage: ionoDiff.py output.csv solution [solution ...]
+# The obsid is taken from the start of each solution file name, e.g. 1234567890_local_gleam_model_solutions_ts10.bin.
+# Set DIP_IONODIFF_RMS=1 to add the statistics of the phase RMS.
+
+# The body is guarded as aocal_diff.batch starts a process pool, whose workers import this module under spawn or forkserver.
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('ERROR: Incorrect number of parameters.')
+        exit(-1)
+
+    outputFile = sys.argv[1]
+    solutions = []
+    for solution in sys.argv[2:]:
+        obsid = os.path.basename(solution).split('_')[0]
+        if not obsid.isdigit():
+            print(f'ERROR: Unable to find the obsid of {solution}.')
+            exit(-1)
+        solutions.append((obsid, solution, aoSolution.referenceAntenna(obsid)))
+
+    rms = os.environ.get('DIP_IONODIFF_RMS', '').lower() in ('1', 'true', 'yes')
+    aocal_diff.batch(solutions, outputFile, rms=rms, workers=resources.availableCores())
+    print(f'Wrote the statistics of {len(solutions)} observations to {outputFile}.')
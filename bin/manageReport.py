@@ -2,33 +2,64 @@
 
 import os
 import sys
+import time
 import shutil
+import signal
 import pandas as pd
 import report
+import reportSummary
+import asvoJobs
+import msVerify
+import scratchManager
+import stageTiming
 import subprocess
 from mantaray.api import Session
 
 
 asvoPath = '/scratch/mwasci/asvo/'
 numberObs = 120
+# Seconds between the cycles of the streaming mode and the files in the observation directory used to end it.
+streamInterval = 300
+streamDoneFile = 'DIP_STREAM_DONE'
+streamStopFile = 'DIP_STREAM_STOP'
 
-if not (len(sys.argv) >= 2 and len(sys.argv) <= 4):
+if not (len(sys.argv) >= 2 and len(sys.argv) <= 5):
     print('ERROR: Incorrect number of parameters.')
     exit(-1)
 
 action = sys.argv[1]
+args = sys.argv[2:]
+
+# Status takes --refresh to verify the report against ASVO and the processed files before counting.
+# Query takes an expression, e.g. "rms_MFS < 0.005 and 0.9 < ratio_MFS < 1.1" or "all", and an optional .csv or .parquet to export to.
+queryExpr = ''
+queryOutput = ''
+if action == 'query':
+    if len(args) == 0:
+        print('ERROR: A query expression is required.')
+        exit(-1)
+    queryExpr = args.pop(0)
+elif len(args) > 2:
+    print('ERROR: Incorrect number of parameters.')
+    exit(-1)
 
 configFile = 'nextflow.config'
-if len(sys.argv) >= 3:
-    for i in range(2,len(sys.argv)):
-        if sys.argv[i].isnumeric():
-            numberObs = int(sys.argv[i])
-        else:
-            configFile = sys.argv[i]
+refresh = False
+for arg in args:
+    if arg == '--refresh':
+        refresh = True
+    elif arg.isnumeric():
+        numberObs = int(arg)
+    elif action == 'query' and arg.endswith(('.csv', '.parquet')):
+        queryOutput = arg
+    else:
+        configFile = arg
 
 
 reportCsv = ''
 obsDir = ''
+reportJournal = ''
+scratchQuota = ''
 with open(configFile) as f:
     for line in f:
         if 'reportCsv=' in line.replace(' ', ''):
@@ -41,26 +72,64 @@ with open(configFile) as f:
             obsDir = obsDir.replace('"', '')
             obsDir = obsDir.replace("'", "")
             obsDir = os.path.expandvars(obsDir)
+        if 'reportJournal=' in line.replace(' ', ''):
+            reportJournal = line.split('=',1)[1].strip()
+            reportJournal = reportJournal.replace('"', '')
+            reportJournal = reportJournal.replace("'", "")
+            reportJournal = os.path.expandvars(reportJournal)
+        if 'scratchQuota=' in line.replace(' ', ''):
+            scratchQuota = line.split('=',1)[1].strip()
+            scratchQuota = scratchQuota.replace('"', '')
+            scratchQuota = scratchQuota.replace("'", "")
 
 if reportCsv == '' or obsDir == '':
     print('Error: Unable to find the data entries in the nextflow.config.')
     exit()
 
 
-# Verify the download data is there, return True if it is, False if it is missing.
-def verifyDownload(obsid, jobid, quietMode=False):
-    asvoObsPath = os.path.join(asvoPath, str(jobid))
-    msPath = os.path.join(asvoObsPath, str(obsid) + '.ms')
-    # Check the measurement set in the ASVO path is there, if not flag to redownload when possible.
-    if not os.path.exists(msPath):
-        report.updateObs(reportCsv, obsid, 'status', 'Error - Missing Measurement Set', quiet=quietMode)
-        report.updateObs(reportCsv, obsid, 'job_status', 'Missing Data', quiet=quietMode)
-        return False
+# Add updates for an observation to the updates to be written to the report in a single pass.
+def queueUpdate(updates, obsid, values):
+    updates.setdefault(str(obsid)[0:10], {}).update(values)
+
+
+# Observations which are finished for good, failed or with their ASVO delivery purged.
+# They are never verified, linked or downloaded again, as their measurement sets are expected to be gone.
+def retired(reportDF):
+    cols = reportDF.reindex(columns=['status', 'job_status', 'asvo_purged'])
+    return (cols['status'] == 'Failed') | (cols['job_status'] == 'Purged') | cols['asvo_purged'].notna()
+
+
+# Path of the measurement set delivered by ASVO for an observation.
+def downloadPath(obsid, jobid):
+    return msVerify.msPath(asvoPath, obsid, jobid)
+
+
+# Verify the measurement sets for many observations, [(obsid, jobid)], in parallel before they are checked by verifyDownload.
+# Measurement sets which have not changed since they were last verified are not opened again.
+# The manifest is only loaded by the actions which verify downloads.
+msManifest = None
+msErrors = {}
+def checkDownloads(jobs):
+    global msManifest
+    if msManifest is None:
+        msManifest = msVerify.readManifest(reportCsv)
+    msPaths = [downloadPath(obsid, jobid) for obsid, jobid in jobs]
+    msErrors.update(msVerify.verifyAll(msPaths, msManifest))
+    msVerify.writeManifest(reportCsv, msManifest)
+    unchecked = msVerify.uncheckedTables(msPaths, msManifest)
+    if len(unchecked) > 0:
+        print(f'WARNING: The tables of {len(unchecked)} measurement sets have not been checked as casacore is unavailable, run msVerify.py in the dip container.')
+
 
-    # Check the measurement set if the FLAG_CMD table is present, if not flag to redownload when possible.
-    if not os.path.exists(os.path.join(msPath, 'FLAG_CMD/table.dat')):
-        report.updateObs(reportCsv, obsid, 'status', 'Error - Missing FLAG_CMD Table.', quiet=quietMode)
-        report.updateObs(reportCsv, obsid, 'job_status', 'Missing Data', quiet=quietMode)
+# Verify the download data is there and complete, return True if it is, False if it is missing or incomplete.
+# Any errors are added to updates to be written to the report, to flag to redownload when possible.
+def verifyDownload(obsid, jobid, updates):
+    msPath = downloadPath(obsid, jobid)
+    if msPath not in msErrors:
+        checkDownloads([(obsid, jobid)])
+
+    if msErrors[msPath] is not None:
+        queueUpdate(updates, obsid, {'status': f'Error - {msErrors[msPath]}', 'job_status': 'Missing Data'})
         return False
     
     return True
@@ -77,9 +146,62 @@ port = '443'
 https = '1'
 
 
+# Filter, summarise and export the typed report.
+if action == 'query':
+    reportDF = report.readTypedReport(reportCsv)
+    if queryExpr != 'all':
+        reportDF = reportDF.query(queryExpr)
+    print(f'Matched {len(reportDF.index)} observations.')
+
+    numericDF = reportDF.select_dtypes('number')
+    if len(reportDF.index) > 0 and len(numericDF.columns) > 0:
+        print(numericDF.describe().T.to_string())
+
+    if queryOutput.endswith('.parquet'):
+        reportDF.to_parquet(queryOutput)
+        print(f'Exported to {queryOutput}')
+    elif queryOutput.endswith('.csv'):
+        reportDF.to_csv(queryOutput)
+        print(f'Exported to {queryOutput}')
+    else:
+        for obsid in reportDF.index:
+            print(obsid)
+
+
+# Summarise the stage timing and resource usage recorded by calibrate.py, image.py and postImage.py.
+if action == 'timing':
+    reportDF = report.readTypedReport(reportCsv)
+
+    stages = [col[:-len('_wall_s')] for col in reportDF.columns if col.endswith('_wall_s')]
+    summary = []
+    for stage in stages:
+        for metric in ['wall_s', 'cpu_s', 'maxrss_mb']:
+            values = reportDF[f'{stage}_{metric}'].dropna()
+            if len(values.index) == 0:
+                continue
+            summary.append(dict(stage=stage, metric=metric, count=len(values.index), mean=values.mean(),
+                p50=values.quantile(0.5), p90=values.quantile(0.9), p99=values.quantile(0.99), max=values.max()))
+
+    if len(summary) == 0:
+        print('No stage timing recorded in the report.')
+    else:
+        print(pd.DataFrame(summary).set_index(['stage', 'metric']).round(1).to_string())
+
+    # Throughput of completed observations over the time from the first stage starting to the last observation completing.
+    startCols = [col for col in reportDF.columns if col.endswith('_start')]
+    if 'postImage_MFS_end' in reportDF.columns and len(startCols) > 0:
+        completed = reportDF[reportDF['postImage_MFS'] == 'Success']['postImage_MFS_end'].dropna()
+        firstStart = reportDF[startCols].min(axis=1).min()
+        if len(completed.index) > 0 and pd.notnull(firstStart):
+            hours = (completed.max() - firstStart).total_seconds() / 3600
+            print(f'\nCompleted Observations: {len(completed.index)}')
+            if hours > 0:
+                print(f'Throughput: {len(completed.index) / hours:.2f} observations per hour')
+
+
 if action == 'create':
     # Otherwise check the report and verify.
-    reportDF = pd.read_csv(reportCsv, dtype=str, index_col='obsid')
+    reportDF = report.readReport(reportCsv)
 
     if 'status' not in reportDF.columns:
         reportDF['status'] = ''
@@ -96,50 +218,99 @@ if action == 'create':
 
     # Create a maximum of 120 symlinks but still run through the entire operation to ensure old symlinks,
     # such as those that have reached their attempt limit, are removed.
-    count = 0
-    for obsid, row in reportDF.iterrows():
-        asvoObsPath = os.path.join(asvoPath, reportDF.at[obsid, 'jobid'])
-        msPath = os.path.join(asvoObsPath, f'{obsid}.ms')
+    updates = {}
+    retiredObs = retired(reportDF)
+    checkDownloads(zip(reportDF.index[~retiredObs], reportDF['jobid'][~retiredObs]))
+    verified = pd.Series(False, index=reportDF.index)
+    trashDirs = set()
+    for obsid in reportDF.index:
         obsPath = os.path.join(obsDir, str(obsid))
 
         # Is the folder or symlink already exists, delete and recreate.
+        # Old folders are moved aside and deleted in the background.
         if os.path.exists(obsPath):
             if os.path.isdir(obsPath) and not os.path.islink(obsPath):
-                shutil.rmtree(obsPath)
+                trashDirs.add(scratchManager.moveToTrash(obsPath))
             if os.path.islink(obsPath):
                 os.unlink(obsPath)
 
         # If the measurement set data is not there or incomplete, skip.
-        if verifyDownload(obsid, reportDF.at[obsid, 'jobid']) == False:
-            continue
+        if not retiredObs[obsid]:
+            verified[obsid] = verifyDownload(obsid, reportDF.at[obsid, 'jobid'], updates)
+
+    # Skip failed observations, if < 3 attempts create a new symlink otherwise mark the observation as failed.
+    # IF attempt field is empty, treat it as 0.
+    attempts = reportDF['attempts'].fillna(0).astype(int)
+    candidates = verified & (reportDF['status'] != 'Failed')
+    failed = candidates & (attempts >= 3)
+    initiate = candidates & (attempts < 3)
+    initiate = initiate & (initiate.cumsum() <= numberObs)
+
+    obsStatus = pd.Series('', index=reportDF.index)
+    obsStatus[initiate] = 'Initiated'
+    obsStatus[failed] = 'Failed'
+
+    for obsid in reportDF.index[initiate]:
+        os.symlink(os.path.join(asvoPath, reportDF.at[obsid, 'jobid']), os.path.join(obsDir, str(obsid)))
+    for obsid in reportDF.index[candidates]:
+        queueUpdate(updates, obsid, {'status': obsStatus[obsid]})
+
+    report.updateMultipleObs(reportCsv, updates, quiet=False)
+    scratchManager.emptyTrashInBackground(trashDirs)
+    count = int(initiate.sum())
 
-        # If it is a failed observation, skip.
-        if row['status'] == 'Failed':
-            continue
+    print(f'Created {count} symlinks.')
+
+
+# Create symlinks for newly downloaded observations without touching the existing ones, used by the streaming mode
+# so the observations already picked up by Nextflow are not removed or linked again.
+if action == 'link':
+    reportDF = report.readReport(reportCsv)
+
+    for col in ['status', 'attempts', 'jobid', 'job_status']:
+        if col not in reportDF.columns:
+            reportDF[col] = float('nan')
+
+    # Only observations which have been downloaded, have not been started and do not already have a symlink or folder.
+    reportDF = reportDF[(reportDF['job_status'] == 'Downloaded') & (reportDF['status'].isna() | (reportDF['status'] == ''))]
+    linked = pd.Series([os.path.lexists(os.path.join(obsDir, str(obsid))) for obsid in reportDF.index], index=reportDF.index, dtype=bool)
+    reportDF = reportDF[~linked]
 
-        report.updateObs(reportCsv, obsid, 'status', '')
+    updates = {}
+    checkDownloads(zip(reportDF.index, reportDF['jobid']))
+    verified = pd.Series([verifyDownload(obsid, reportDF.at[obsid, 'jobid'], updates) for obsid in reportDF.index], index=reportDF.index, dtype=bool)
 
-        # IF attempt field is empty, treat it as 0.
-        reportDF['attempts'] = reportDF['attempts'].fillna(0)
-        # If < 3 attempts, create the new symlink.
-        if int(reportDF.at[obsid, 'attempts']) < 3 and count < numberObs:
-            os.symlink(asvoObsPath, obsPath)
-            report.updateObs(reportCsv, obsid, 'status', 'Initiated')
-            count = count + 1
+    attempts = reportDF['attempts'].fillna(0).astype(int)
+    failed = verified & (attempts >= 3)
+    initiate = verified & (attempts < 3)
+    initiate = initiate & (initiate.cumsum() <= numberObs)
 
-        if int(reportDF.at[obsid, 'attempts']) >= 3:
-            report.updateObs(reportCsv, obsid, 'status', 'Failed')
+    for obsid in reportDF.index[initiate]:
+        os.symlink(os.path.join(asvoPath, reportDF.at[obsid, 'jobid']), os.path.join(obsDir, str(obsid)))
+        queueUpdate(updates, obsid, {'status': 'Initiated'})
+    for obsid in reportDF.index[failed]:
+        queueUpdate(updates, obsid, {'status': 'Failed'})
+
+    report.updateMultipleObs(reportCsv, updates, quiet=False)
+    count = int(initiate.sum())
 
     print(f'Created {count} symlinks.')
 
 
 # Verbose output for the verify method.
 # For check status, silently update the spreadsheet.
-if action == 'verify' or action == 'status':
+if action == 'verify' or (action == 'status' and refresh):
+    # Fold the report journals written by the processing tasks into the report before verifying it.
+    if reportJournal != '' and os.path.isdir(reportJournal):
+        print(f'Merging report journals from {reportJournal}')
+        mergedCount = report.mergeJournals(reportCsv, reportJournal)
+        print(f'Merged journal updates for {mergedCount} observations.')
+
     print(f'Loading {reportCsv}')
     #reportDF = pd.read_csv(reportCsv, dtype=str)
     #reportDF.set_index('obsid', inplace=True)
-    reportDF = pd.read_csv(reportCsv, dtype=str, index_col='obsid')
+    reportDF = report.readReport(reportCsv)
+    reportDF = reportDF[~retired(reportDF)]
 
     # if 'status' not in reportDF.columns:
     #     reportDF['status'] = ''
@@ -165,29 +336,42 @@ if action == 'verify' or action == 'status':
     if action == 'status':
         quietMode = True
 
+    updates = {}
     apiKey = os.getenv('MWA_ASVO_API_KEY')
     # If the API key is set, check if any new downloads have been completed.
-    if apiKey != None:
+    # The job list is only downloaded when a job may have changed and only values which differ from the report are written.
+    jobCache = asvoJobs.readCache(reportCsv)
+    if apiKey != None and not asvoJobs.needsSync(jobCache, reportDF.get('job_status', pd.Series(dtype=str))):
+        print('No ASVO jobs in progress.')
+    elif apiKey != None:
         print('Downloading ASVO Job Information.')
         session = Session.login('1', 'asvo.mwatelescope.org', '443', apiKey)
-        jobList = session.get_jobs()
+        jobList = asvoJobs.syncJobs(session, jobCache)
+        asvoJobs.writeCache(reportCsv, jobCache)
+
+        # Verify the newly completed downloads together.
+        checkDownloads([(obsID, jobID) for obsID, jobID, jobState in jobList if jobState == 'completed' and obsID in reportDF.index and reportDF.at[obsID, 'job_status'] != 'Downloaded'])
 
-        for job in jobList:
-            obsID = job['row']['job_params']['obs_id']
-            jobID = job['row']['id']
-            jobState = job['row']['job_state']
+        jobUpdates = {}
+        for obsID, jobID, jobState in jobList:
             if obsID in reportDF.index:
-                report.updateObs(reportCsv, obsID, 'jobid', jobID, quiet=quietMode)
+                queueUpdate(jobUpdates, obsID, {'jobid': jobID})
 
                 if jobState != 'completed':
-                    report.updateObs(reportCsv, obsID, 'job_status', f'{jobState}', quiet=quietMode)
+                    queueUpdate(jobUpdates, obsID, {'job_status': f'{jobState}'})
                 if jobState == 'completed':
                     # Ensure the mesaurement set data is there and complete and mark as downloaded if it is.
                     if reportDF.at[obsID, 'job_status'] != 'Downloaded':
-                        if verifyDownload(obsID, jobID, quietMode) == True:
-                            report.updateObs(reportCsv, obsID, 'job_status', 'Downloaded', quiet=quietMode)
+                        if verifyDownload(obsID, jobID, jobUpdates) == True:
+                            queueUpdate(jobUpdates, obsID, {'job_status': 'Downloaded'})
                         else:
-                            report.updateObs(reportCsv, obsID, 'job_status', 'Download Error', quiet=quietMode)
+                            queueUpdate(jobUpdates, obsID, {'job_status': 'Download Error'})
+
+        for obsID, values in jobUpdates.items():
+            changed = {col: val for col, val in values.items() if col not in reportDF.columns or reportSummary.normalise(reportDF.at[obsID, col]) != reportSummary.normalise(val)}
+            queueUpdate(updates, obsID, changed)
+        if not quietMode:
+            print(f'ASVO job changes for {sum(1 for values in updates.values() if len(values) > 0)} observations.')
     
 
     # Filter the reportDF to remove any bad observations.
@@ -217,55 +401,46 @@ if action == 'verify' or action == 'status':
 
     if processingStarted:
         count = 0
-        for obsid, row in reportDF.iterrows():
-            missing = False
-
-            # Check to ensure the files for the subchans have been published as reported.
-            #for subchan in ['0000', '0001', '0002', '0003', 'MFS']:for subchan in ['0000', '0001', '0002', '0003', 'MFS']:
-            for subchan in ['MFS']:
-                reportObsDir = row['obsDir']
-                # If the observation directory entry is missing, try the oneb in the nextflow.config.
-                if pd.isna(reportObsDir):
-                    reportObsDir = obsDir
-                    report.updateObs(reportCsv, obsid, 'obsDir', obsDir, quiet=quietMode)
-
-                file = f'{reportObsDir}/{obsid}/{obsid}_deep-{subchan}-image-pb_warp_scaled.fits'
-                if not os.path.exists(file):
-                    missing = True
-                    break
-            
-            # If any subchan for obsid missing, Clear the report entry (updating error count), delete the folder, recreate symlink if erorr count < 3.
-            if missing == False:
-                report.updateObs(reportCsv, obsid, 'status', 'Success', quiet=quietMode)
-            else:
-                report.updateObs(reportCsv, obsid, 'status', 'Missing Data', quiet=quietMode)
+        # Check to ensure the files for the subchans have been published as reported.
+        # If the observation directory entry is missing, try the one in the nextflow.config.
+        missingDir = reportDF['obsDir'].isna()
+        reportObsDir = reportDF['obsDir'].fillna(obsDir)
+        subchan = 'MFS'
+        published = pd.Series([os.path.exists(f'{reportObsDir[obsid]}/{obsid}/{obsid}_deep-{subchan}-image-pb_warp_scaled.fits') for obsid in reportDF.index], index=reportDF.index, dtype=bool)
+
+        # If any subchan for obsid missing, Clear the report entry (updating error count), delete the folder, recreate symlink if erorr count < 3.
+        obsStatus = pd.Series('Missing Data', index=reportDF.index)
+        obsStatus[published] = 'Success'
+        for obsid in reportDF.index:
+            if missingDir[obsid]:
+                queueUpdate(updates, obsid, {'obsDir': obsDir})
+            queueUpdate(updates, obsid, {'status': obsStatus[obsid]})
 
         if not quietMode:
             print('Found ' + str(count) + ' errors.')
 
+    # Write all the changes to the report at once and refresh the typed snapshot used by query.
+    report.updateMultipleObs(reportCsv, updates, quiet=quietMode)
+    report.writeSnapshot(reportCsv)
 
-if action == 'status':
-    #reportDF = pd.read_csv(reportCsv, dtype=str)
-    #reportDF.set_index('obsid', inplace=True)
-    reportDF = pd.read_csv(reportCsv, dtype=str, index_col='obsid')
-
-    if 'status' not in reportDF.columns:
-        reportDF['status'] = ''
 
+if action == 'status':
     # Count of: Total observations, jobs needing to be downloaded, submitted/queued/processing jobs, completed jobs, obs processed, obs queued/running, obs failed, obs successful.
-    totalObs = len(reportDF.index)
-
-    jobsNotDownloaded = len(reportDF[pd.isnull(reportDF['jobid'])].index)
-    jobsSubmitted = len(reportDF[pd.notnull(reportDF['job_status']) & (reportDF['job_status'] != 'Downloaded') & (reportDF['job_status'] != 'Missing Data')].index)
-    jobsErrors = len(reportDF[reportDF['job_status'] == 'Missing Data'].index)
-    jobsDownloaded = len(reportDF[reportDF['job_status'] == 'Downloaded'].index)
-    obsProcessed = len(reportDF[pd.notnull(reportDF['status']) | reportDF['status'] == ''].index)
-
-    obsQueued = len(reportDF[reportDF['status'] == 'Queued'].index)
-    obsFailed = len(reportDF[reportDF['status'] == 'Failed'].index)
-    obsMissing = len(reportDF[reportDF['status'] == 'Missing Data'].index)
-    obsReady = len(reportDF[(reportDF['status'] != 'Success') & (reportDF['status'] != 'Failed') & (reportDF['job_status'] == 'Downloaded')].index)
-    obsSuccess = len(reportDF[reportDF['status'] == 'Success'].index)
+    # Read from the summary index maintained by each report update, with --refresh it is rebuilt from the verified report.
+    counts = reportSummary.statusCounts(report.readSummary(reportCsv, refresh=refresh))
+    totalObs = counts['totalObs']
+
+    jobsNotDownloaded = counts['jobsNotDownloaded']
+    jobsSubmitted = counts['jobsSubmitted']
+    jobsErrors = counts['jobsErrors']
+    jobsDownloaded = counts['jobsDownloaded']
+    obsProcessed = counts['obsProcessed']
+
+    obsQueued = counts['obsQueued']
+    obsFailed = counts['obsFailed']
+    obsMissing = counts['obsMissing']
+    obsReady = counts['obsReady']
+    obsSuccess = counts['obsSuccess']
 
     print(f'DIP Status: {reportCsv}\n')
     print(f'Total Observations: {totalObs}\n')
@@ -290,16 +465,13 @@ if action == 'download':
         exit(-1)
 
     session = Session.login('1', 'asvo.mwatelescope.org', '443', apiKey)
-    jobList = session.get_jobs()
 
-    # Create a list of Obs IDs with jobs currently submitted.
-    obsIDList = []
-    for job in jobList:
-        obsIDList.append(job['row']['job_params']['obs_id'])
+    # Create a list of Obs IDs with jobs currently submitted, from the job cache kept up to date by verify.
+    jobCache = asvoJobs.readCache(reportCsv)
+    obsIDList = [job['obsid'] for job in jobCache['jobs'].values()]
 
     print('Loading ' + reportCsv)
-    reportDF = pd.read_csv(reportCsv, dtype=str)
-    reportDF.set_index('obsid', inplace=True)
+    reportDF = report.readReport(reportCsv)
 
     # Check to ensure columns required exist, if not, create them.
     if 'jobid' not in reportDF.columns:
@@ -308,7 +480,7 @@ if action == 'download':
         reportDF['job_status'] = ''
 
     # Check how many observations are currently being downloaded.
-    jobsSubmitted = len(reportDF[pd.notnull(reportDF['job_status']) & (reportDF['job_status'] != '') & (reportDF['job_status'] != 'Downloaded') & (reportDF['job_status'] != 'Missing Data')].index)
+    jobsSubmitted = len(reportDF[pd.notnull(reportDF['job_status']) & ~reportDF['job_status'].isin(['', 'Downloaded', 'Missing Data', 'Purged'])].index)
     maxObs = numberObs
     numberObs = numberObs - jobsSubmitted
 
@@ -317,7 +489,23 @@ if action == 'download':
         print(f'Maximum number of concurrent downloads already submitted: {maxObs}')
         exit()
 
+    # Limit the downloads so the ASVO deliveries on scratch stay under the quota, if one is set in nextflow.config.
+    # The size of each new observation is estimated from the median of the downloads on disk.
+    if scratchQuota != '':
+        quota = scratchManager.parseSize(scratchQuota)
+        onDisk = reportDF[(reportDF['job_status'] == 'Downloaded') & (reportDF['asvo_purged'].isna() if 'asvo_purged' in reportDF.columns else True)]
+        sizes = pd.Series(scratchManager.jobBytes(asvoPath, onDisk['jobid']), dtype=float)
+        usedBytes = sizes.sum()
+        obsBytes = sizes[sizes > 0].median() if (sizes > 0).any() else scratchManager.defaultObsBytes
+        allowed = scratchManager.admit(numberObs, usedBytes, jobsSubmitted, quota, obsBytes)
+        print(f'Scratch usage: {scratchManager.formatSize(usedBytes)} of {scratchManager.formatSize(quota)}, {jobsSubmitted} jobs in flight of about {scratchManager.formatSize(obsBytes)} each.')
+        if allowed < 1:
+            print('Scratch quota reached, not submitting any downloads.')
+            exit()
+        numberObs = allowed
+
     # Filter for only obs left to download.
+    reportDF = reportDF[~retired(reportDF)]
     reportDF = reportDF[pd.isnull(reportDF['jobid']) | (reportDF['job_status'] == '') | (reportDF['job_status'] == 'Missing Data') | (reportDF['job_status'] == 'cancelled') | (reportDF['job_status'] == 'error')]
     print(f'Total observations left to download: {len(reportDF.index)}')
     print(f'Queueing a maximum of {numberObs} observations.')
@@ -331,27 +519,82 @@ if action == 'download':
     params['output'] = 'ms'
     params['delivery'] = 'scratch'
 
+    # Submit the jobs concurrently, the results are written to the report in a single update.
     count = 0
-    for obsID, row in reportDF.iterrows():
-        # Check if a job already exists for the Obs ID, if so skip it.
-        # if obsID in obsIDList:
-        #     continue
-
-        params['obs_id'] = obsID
-        # Submit job.
-        try:
-            jobResponse = session.submit_conversion_job_direct(params)
-            jobID = jobResponse['job_id']
-            report.updateObs(reportCsv, obsID, 'jobid', jobID, quiet=True)
-            report.updateObs(reportCsv, obsID, 'job_status', 'Submitted', quiet=True)
-            print(f'Submitted {obsID} with Job ID {jobID}.')
-            count = count + 1
-        except:
-            print(f'Failed to submit {obsID}.')
-
-        # If the maximum number of jobs have been reached, break.
-        if count >= numberObs:
-            break
+    updates = {}
+    for obsID, jobID, error in asvoJobs.submitJobs(session, list(reportDF.index), params, numberObs):
+        if jobID is None:
+            print(f'Failed to submit {obsID}: {error}')
+            continue
+        queueUpdate(updates, obsID, {'jobid': jobID, 'job_status': 'Submitted'})
+        print(f'Submitted {obsID} with Job ID {jobID}.')
+        asvoJobs.addJobs(jobCache, [(obsID, jobID)])
+        count = count + 1
 
+    report.updateMultipleObs(reportCsv, updates)
+    asvoJobs.writeCache(reportCsv, jobCache)
     print(f'Submitted {count} observations.')
 
+
+
+# Reclaim the scratch space of observations which are finished, successfully or failed for good.
+# Their ASVO deliveries, and the symlinks of the failed observations, are moved aside and deleted in the background.
+# The size of each delivery is recorded in the report as asvo_bytes and the job status set to Purged, so they are not verified or downloaded again.
+if action == 'purge':
+    reportDF = report.readReport(reportCsv)
+    for col in ['status', 'jobid', 'asvo_purged']:
+        if col not in reportDF.columns:
+            reportDF[col] = float('nan')
+
+    finished = reportDF[reportDF['status'].isin(['Success', 'Failed']) & reportDF['jobid'].notna() & reportDF['asvo_purged'].isna()]
+    sizes = scratchManager.jobBytes(asvoPath, finished['jobid'])
+
+    updates = {}
+    trashDirs = set()
+    for obsid in finished.index:
+        jobPath = os.path.join(asvoPath, str(finished.at[obsid, 'jobid']))
+        if os.path.lexists(jobPath):
+            trashDirs.add(scratchManager.moveToTrash(jobPath))
+        obsPath = os.path.join(obsDir, str(obsid))
+        if finished.at[obsid, 'status'] == 'Failed' and os.path.islink(obsPath):
+            os.unlink(obsPath)
+        queueUpdate(updates, obsid, {'asvo_bytes': sizes[str(finished.at[obsid, 'jobid'])], 'asvo_purged': stageTiming.timestamp(time.time()), 'job_status': 'Purged'})
+
+    report.updateMultipleObs(reportCsv, updates)
+    scratchManager.emptyTrashInBackground(trashDirs)
+    print(f'Purged {len(updates)} observations, freeing {scratchManager.formatSize(sum(sizes.values()))}.')
+
+# Continuously keep numberObs ASVO jobs in flight and link each observation as soon as its download is verified,
+# so Nextflow run with --stream picks them up while the remaining observations are still downloading.
+# Each cycle runs verify, download and link. When there is nothing left to download, link or wait for, or the stop file
+# is created in the observation directory, the done file is written to end the Nextflow watched channel.
+if action == 'stream':
+    streamDone = os.path.join(obsDir, streamDoneFile)
+    streamStop = os.path.join(obsDir, streamStopFile)
+    if os.path.exists(streamStop):
+        os.remove(streamStop)
+
+    # Finish cleanly if the Slurm job ends or dip.sbatch stops the stream.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    manageReport = os.path.abspath(sys.argv[0])
+    try:
+        while not os.path.exists(streamStop):
+            for cycleAction, cycleArgs in [('verify', []), ('download', [str(numberObs)]), ('link', [str(numberObs)])]:
+                subprocess.run([sys.executable, manageReport, cycleAction] + cycleArgs + [configFile])
+
+            reportDF = report.readReport(reportCsv)
+            for col in ['status', 'jobid', 'job_status']:
+                if col not in reportDF.columns:
+                    reportDF[col] = float('nan')
+            jobStatus = reportDF['job_status'].fillna('')
+            waiting = reportDF['jobid'].notna() & ~jobStatus.isin(['Downloaded', 'Purged', 'Missing Data', 'Download Error', 'cancelled', 'error', 'expired'])
+            toDownload = reportDF['jobid'].isna() | jobStatus.isin(['', 'Missing Data', 'cancelled', 'error'])
+            toLink = (jobStatus == 'Downloaded') & reportDF['status'].fillna('').eq('') & ~pd.Series([os.path.lexists(os.path.join(obsDir, str(obsid))) for obsid in reportDF.index], index=reportDF.index, dtype=bool)
+            print(f'Stream: {int(waiting.sum())} jobs in flight, {int(toDownload.sum())} to download, {int(toLink.sum())} to link.')
+            if not (waiting.any() or toDownload.any() or toLink.any()):
+                break
+            time.sleep(streamInterval)
+    finally:
+        open(streamDone, 'w').close()
+        print('Stream finished.')
@@ -4,6 +4,7 @@ import numpy as np
 import astropy.units as u
 from astropy.io import fits
 from astropy.coordinates import SkyCoord
+import catalogueIndex
 
 gleamCatFile = 'models/GGSM_sparse_unresolved.fits'
 
@@ -23,24 +24,17 @@ def measureRatio(obsCatFile, projectDir):
     #sep = primarySource.separation(objectCoord)
     #obsCat['G9 distance'] = sep.arcsec
 
-    cF = SkyCoord(ra=obsCat['ra'].to_numpy()*u.degree, dec=obsCat['dec'].to_numpy()*u.degree)
-    gleamCoords = SkyCoord(ra=gleamCat['RAJ2000'].to_numpy()*u.degree, dec=gleamCat['DEJ2000'].to_numpy()*u.degree)
-    gleamidx, gleamd2d, gleamd3d = cF.match_to_catalog_sky(gleamCoords)
+    # Match each source to the nearest GLEAM source using the cached spatial index of the GLEAM catalogue.
+    gleamIndex = catalogueIndex.load(os.path.join(projectDir, gleamCatFile))
+    gleamidx, gleamd2d = gleamIndex.nearest(obsCat['ra'].to_numpy(), obsCat['dec'].to_numpy())
 
-    j=0
-    for index, currenObs in obsCat.iterrows():
-        obsCat.at[index, 'gleam name'] = gleamCat['Name'].iloc[gleamidx[j]]
-        obsCat.at[index, 'gleam flux'] = gleamCat['S_200'].iloc[gleamidx[j]] * (215.68 / 200.0) ** gleamCat['alpha'].iloc[gleamidx[j]]
-        obsCat.at[index, 'gleam S200'] = gleamCat['S_200'].iloc[gleamidx[j]] 
-        obsCat.at[index, 'gleam alpha'] = gleamCat['alpha'].iloc[gleamidx[j]]
+    matched = gleamCat.iloc[gleamidx]
+    obsCat['gleam name'] = matched['Name'].to_numpy()
+    obsCat['gleam flux'] = (matched['S_200'] * (215.68 / 200.0) ** matched['alpha']).to_numpy()
+    obsCat['gleam S200'] = matched['S_200'].to_numpy()
+    obsCat['gleam alpha'] = matched['alpha'].to_numpy()
 
-        #c = SkyCoord(ra=currenObs['ra']*u.degree, dec=currenObs['dec']*u.degree)
-        #d2d = c.separation(objectCoord)
-        #obsCat.at[index, 'near'] = len(d2d[d2d < 3*u.arcmin])
-
-        j = j+1
-        
-    obsCat['gleam distance']=gleamd2d.degree
+    obsCat['gleam distance']=gleamd2d
 
     obsCat = obsCat[obsCat['gleam distance'] <= 0.01]
     obsCat = obsCat.sort_values('gleam distance').drop_duplicates(subset='gleam name', keep='first')
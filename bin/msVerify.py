@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import hashlib
+import importlib.util
+import report
+from concurrent.futures import ThreadPoolExecutor
+
+# Integrity checks of the measurement sets delivered by ASVO, used by manageReport.py create and verify.
+# Each measurement set is opened with casacore, every subtable is opened and counted and the last row of the main table is read,
+# so truncated downloads are found before calibration. The results are kept in a manifest next to the report with the
+# file sizes and modification times, so unchanged measurement sets are not checked again.
+# casacore is only imported when the tables are opened, as manageReport.py runs in the mantaray container without it.
+# dip.sbatch runs this script in the dip container first, checking the tables of the downloaded measurement sets of the report.
+# Without casacore a measurement set not yet in the manifest has only its files checked and is recorded with tables unchecked,
+# and one already in the manifest is not walked again, as ASVO deliveries are not changed in place.
+# Usage: msVerify.py reportFile asvoPath
+requiredSubtables = ('ANTENNA', 'DATA_DESCRIPTION', 'FIELD', 'FLAG_CMD', 'OBSERVATION', 'POLARIZATION', 'SPECTRAL_WINDOW')
+# Subtables which must have at least one row.
+populatedSubtables = ('ANTENNA', 'DATA_DESCRIPTION', 'FIELD', 'OBSERVATION', 'POLARIZATION', 'SPECTRAL_WINDOW')
+workers = 8
+
+
+def casacoreAvailable():
+    return importlib.util.find_spec('casacore') is not None
+
+# Path of the measurement set delivered by ASVO for an observation.
+def msPath(asvoPath, obsid, jobid):
+    return os.path.join(asvoPath, str(jobid), str(obsid) + '.ms')
+
+
+# Number of files, total size, latest modification time and a digest of the listing of the measurement set.
+def fileSignature(msPath):
+    listing = []
+    for root, dirs, files in os.walk(msPath):
+        for name in files:
+            stat = os.stat(os.path.join(root, name))
+            listing.append((os.path.relpath(os.path.join(root, name), msPath), stat.st_size, stat.st_mtime_ns))
+    listing.sort()
+    digest = hashlib.sha1(json.dumps(listing).encode()).hexdigest()
+    return dict(files=len(listing), bytes=sum(size for name, size, mtime in listing), mtime=max((mtime for name, size, mtime in listing), default=0), digest=digest)
+
+
+# Open the measurement set and its subtables, returning the row counts, raises an error describing any problem.
+def checkTables(msPath):
+    from casacore.tables import table
+
+    mainTable = table(msPath, readonly=True, ack=False)
+    try:
+        rows = mainTable.nrows()
+        subtables = {os.path.basename(os.path.normpath(sub)): sub for sub in mainTable.getsubtables()}
+        missing = [name for name in requiredSubtables if name not in subtables]
+        if len(missing) > 0:
+            raise RuntimeError(f'Missing subtables {", ".join(missing)}')
+
+        subtableRows = {}
+        for name, sub in subtables.items():
+            subTable = table(sub, readonly=True, ack=False)
+            subtableRows[name] = subTable.nrows()
+            subTable.close()
+        empty = [name for name in populatedSubtables if subtableRows[name] == 0]
+        if len(empty) > 0:
+            raise RuntimeError(f'Empty subtables {", ".join(empty)}')
+
+        # The main table holds one row per baseline for each time step, with or without the autocorrelations.
+        nant = subtableRows['ANTENNA']
+        if rows == 0 or (rows % (nant * (nant + 1) // 2) != 0 and rows % (nant * (nant - 1) // 2) != 0):
+            raise RuntimeError(f'Main table has {rows} rows for {nant} antennas')
+
+        # Read the last row so a truncated data file is found now rather than during calibration.
+        for col in ['TIME', 'DATA', 'FLAG']:
+            if col in mainTable.colnames():
+                mainTable.getcell(col, rows - 1)
+    finally:
+        mainTable.close()
+    return rows, subtableRows
+
+
+# Verify a measurement set, reusing the previous result if its files have not changed.
+# Returns the manifest entry, error is None if the measurement set is complete or its tables could not be checked.
+# ok is None and tables is 'unchecked' when only the files could be checked.
+def verifyMS(msPath, previous=None):
+    if not os.path.exists(msPath):
+        return dict(ok=False, error='Missing Measurement Set')
+    if not os.path.exists(os.path.join(msPath, 'FLAG_CMD/table.dat')):
+        return dict(ok=False, error='Missing FLAG_CMD Table.')
+
+    tablesAvailable = casacoreAvailable()
+    if previous is not None and not tablesAvailable:
+        return previous
+
+    signature = fileSignature(msPath)
+    if previous is not None and previous.get('digest') == signature['digest'] and previous.get('tables') != 'unchecked':
+        return previous
+
+    entry = dict(signature, verified=time.time(), tables='unchecked', ok=None, error=None)
+    if not tablesAvailable:
+        return entry
+    try:
+        entry['rows'], entry['subtables'] = checkTables(msPath)
+        entry['tables'] = 'checked'
+        entry['ok'] = True
+        entry['error'] = None
+    except ImportError:
+        return entry
+    except Exception as e:
+        entry['tables'] = 'checked'
+        entry['ok'] = False
+        entry['error'] = f'Incomplete Measurement Set: {e}'
+    return entry
+
+
+def manifestFile(reportFile):
+    return os.path.splitext(reportFile.rstrip(os.sep))[0] + '.ms_manifest.json'
+
+def readManifest(reportFile):
+    file = manifestFile(reportFile)
+    if os.path.exists(file):
+        try:
+            with open(file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+    return {}
+
+def writeManifest(reportFile, manifest):
+    file = manifestFile(reportFile)
+    with open(file + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(file + '.tmp', file)
+
+
+# Measurement sets in the manifest which have only had their files checked.
+def uncheckedTables(msPaths, manifest):
+    return [msPath for msPath in msPaths if manifest.get(msPath, {}).get('tables') == 'unchecked']
+
+
+# Verify many measurement sets in parallel, updating the manifest with the results.
+# The checks are I/O bound and casacore releases the GIL, so threads are used.
+# Returns {msPath: error}, error is None for a complete measurement set or one with unchecked tables.
+def verifyAll(msPaths, manifest, workers=workers):
+    msPaths = list(dict.fromkeys(msPaths))
+    if len(msPaths) == 0:
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(msPaths)))) as pool:
+        entries = list(pool.map(verifyMS, msPaths, [manifest.get(msPath) for msPath in msPaths]))
+
+    errors = {}
+    for msPath, entry in zip(msPaths, entries):
+        # Only measurement sets which were found are recorded, a missing one is cheap to check again.
+        if 'digest' in entry:
+            manifest[msPath] = entry
+        else:
+            manifest.pop(msPath, None)
+        errors[msPath] = entry['error']
+    return errors
+
+
+# Check the tables of the measurement sets of the observations which are downloaded, or being downloaded, and not yet finished,
+# so manageReport.py create and verify can use the results in the mantaray container.
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('ERROR: Incorrect number of parameters.')
+        exit(-1)
+
+    if not casacoreAvailable():
+        print('ERROR: casacore is required to verify the measurement sets.')
+        exit(-1)
+
+    reportFile = sys.argv[1]
+    asvoPath = sys.argv[2]
+    reportDF = report.readReport(reportFile).reindex(columns=['status', 'job_status', 'jobid', 'asvo_purged'])
+    reportDF = reportDF[reportDF['jobid'].notna() & ~reportDF['status'].isin(['Success', 'Failed']) & (reportDF['job_status'] != 'Purged') & reportDF['asvo_purged'].isna()]
+
+    manifest = readManifest(reportFile)
+    errors = verifyAll([msPath(asvoPath, obsid, jobid) for obsid, jobid in zip(reportDF.index, reportDF['jobid'])], manifest)
+    writeManifest(reportFile, manifest)
+    found = [path for path, error in errors.items() if error != 'Missing Measurement Set']
+    print(f'Verified {len(found)} measurement sets, {sum(1 for path in found if errors[path] is not None)} incomplete.')
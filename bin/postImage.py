@@ -3,10 +3,13 @@
 import os
 import sys
 import rms
+import atexit
 import beam
 import shutil
 import report
+import resources
 import catCalcs
+import stageTiming
 import subprocess
 import astropy.units as u
 import measureRatio as mRatio
@@ -29,6 +32,15 @@ ra = float(sys.argv[5])
 dec = float(sys.argv[6])
 
 
+# Collect the report updates for the subchan and write them when the script exits, including on failure or SIGTERM,
+# and at the milestones of the stage so the progress is kept if the task is killed.
+# The stage timing and resource usage is added to the updates just before they are written at exit.
+obsReport = report.transaction(reportCsv, obsid)
+atexit.register(obsReport.commit)
+report.commitOnTerminate()
+stageTimer = stageTiming.StageTimer('postImage_' + subchan)
+atexit.register(lambda: obsReport.updateMany(stageTimer.stop()))
+
 # Define relavant file names and paths.
 filePrefix = obsid + '_deep-' + subchan
 obsFiles = dict(
@@ -89,6 +101,7 @@ minsrcs = 500               # Minimum number of sources to accept for observatio
 radius = 50                 # Radius to match sources to in degrees.
 radiusScaling = 6           # Radius to match sources to in degrees to calculate the scaling factor.
 isolationDistance = 0.1     # Min distance between sources to be considered isolated in degrees.
+cores = resources.limitThreads()    # Cores allocated to the task, for BANE, aegean and fits_warp.
 
 # Import header information from the metafits file.
 with fits.open(obsFiles['metafits']) as metaHdu:
@@ -131,19 +144,19 @@ with fits.open(obsFiles['yy']) as obsHdu:
 
 
 # Calculate the RMS for each pn corrected polarization.
-subprocess.run(f'BANE --cores 1 --compress "{obsFiles["xx_pb"]}"', shell=True, check=True)
-subprocess.run(f'BANE --cores 1 --compress "{obsFiles["yy_pb"]}"', shell=True, check=True)
+subprocess.run(f'BANE --cores {cores} --compress "{obsFiles["xx_pb"]}"', shell=True, check=True)
+subprocess.run(f'BANE --cores {cores} --compress "{obsFiles["yy_pb"]}"', shell=True, check=True)
 #rmsXX = rms.calcRMSCoords(obsFiles['xx_pb_rms'], beamCentXX.ra.deg, beamCentXX.dec.deg)
 #rmsYY = rms.calcRMSCoords(obsFiles['yy_pb_rms'], beamCentYY.ra.deg, beamCentYY.dec.deg)
 rmsXX = rms.calcRMS(obsFiles['xx_pb_rms'], obsFiles['beam_xx'])
 rmsYY = rms.calcRMS(obsFiles['yy_pb_rms'], obsFiles['beam_yy'])
-report.updateObs(reportCsv, obsid, 'rms_xx_' + subchan, rmsXX)
-report.updateObs(reportCsv, obsid, 'rms_yy_' + subchan, rmsYY)
+obsReport.update('rms_xx_' + subchan, rmsXX)
+obsReport.update('rms_yy_' + subchan, rmsYY)
 
 
 # Find sources for each polization.
-subprocess.run('aegean --cores=1 --autoload --table="' + obsFiles['xx_pb'] + '" "' + obsFiles['xx_pb'] + '"', shell=True, check=True)
-subprocess.run('aegean --cores=1 --autoload --table="' + obsFiles['yy_pb'] + '" "' + obsFiles['yy_pb'] + '"', shell=True, check=True)
+subprocess.run(f'aegean --cores={cores} --autoload --table="' + obsFiles['xx_pb'] + '" "' + obsFiles['xx_pb'] + '"', shell=True, check=True)
+subprocess.run(f'aegean --cores={cores} --autoload --table="' + obsFiles['yy_pb'] + '" "' + obsFiles['yy_pb'] + '"', shell=True, check=True)
 # Reduce the catalgoue to isolated sources, match)catalgoues exclusion_zone does not do a satiffacory job.
 catCalcs.reduceCat(obsFiles["xx_pb_cat"], obsFiles["xx_pb_reduced_cat"], distance=isolationDistance)
 catCalcs.reduceCat(obsFiles["yy_pb_cat"], obsFiles["yy_pb_reduced_cat"], distance=isolationDistance)
@@ -156,8 +169,9 @@ subprocess.run(f'match_catalogues "{obsFiles["yy_pb_reduced_cat"]}" "{FLUX_MODEL
 Axx = catCalcs.calcA(f'{obsid}_{subchan}_XX', obsFiles['xx_xm'], metadata['FREQCENT'])
 Ayy = catCalcs.calcA(f'{obsid}_{subchan}_YY', obsFiles['yy_xm'], metadata['FREQCENT'])
 
-report.updateObs(reportCsv, obsid, f'Axx_{subchan}', Axx)
-report.updateObs(reportCsv, obsid, f'Ayy_{subchan}', Ayy)
+obsReport.update(f'Axx_{subchan}', Axx)
+obsReport.update(f'Ayy_{subchan}', Ayy)
+obsReport.commit()
 
 # Convert the linear polarizations to Stokes I.
 obsXXHdu = fits.open(obsFiles['xx'])
@@ -182,8 +196,8 @@ os.remove(obsFiles['ipb'])
 os.rename(obsFiles['ipb_mask'], obsFiles['ipb'])
 
 # Calculate RMS and detect sources on the image.
-subprocess.run('BANE --cores 1 --compress "' + obsFiles['ipb'] + '"', shell=True, check=True)
-subprocess.run('aegean --cores=1 --autoload --table="' + obsFiles['ipb'] + '" "' + obsFiles['ipb'] + '"', shell=True, check=True)
+subprocess.run(f'BANE --cores {cores} --compress "' + obsFiles['ipb'] + '"', shell=True, check=True)
+subprocess.run(f'aegean --cores={cores} --autoload --table="' + obsFiles['ipb'] + '" "' + obsFiles['ipb'] + '"', shell=True, check=True)
 
 
 # Check that a sufficient number of sources were detected.
@@ -191,18 +205,20 @@ with fits.open(obsFiles['ipb_cat']) as catHdu:
     cat = catHdu[1].data
     nsrc = len(cat)
 
-report.updateObs(reportCsv, obsid, 'sourcecount_' + subchan, 'Initial - ' + str(nsrc))
+obsReport.update('sourcecount_' + subchan, 'Initial - ' + str(nsrc))
 if nsrc < minsrcs:
     print('ERROR: Not enough sources detected.')
-    report.updateObs(reportCsv, obsid, 'postImage_' + subchan, 'Fail - Not enough sources detected.')
-    report.updateObs(reportCsv, obsid, 'status', 'Failed')
+    obsReport.update('postImage_' + subchan, 'Fail - Not enough sources detected.')
+    obsReport.update('status', 'Failed')
+    obsReport.commit()
     exit(-1)
+obsReport.commit()
 
 # Reduce the catalgoue to isolated sources.
 catCalcs.reduceCat(obsFiles['ipb_cat'], obsFiles['ipb_reduced_cat'], distance=isolationDistance)
 
 subprocess.run('fits_warp.py --incat "' + obsFiles['ipb_reduced_cat'] + '" --refcat "' + POS_MODEL_CATALOGUE + '" --xm "' + obsFiles['xm_complete'] + '" --plot --ra1 ra --dec1 dec --ra2 RAJ2000 --dec2 DEJ2000 --infits "' + obsFiles['ipb'] + '"', shell=True, check=True)
-subprocess.run('fits_warp.py --incat "' + obsFiles['ipb_reduced_cat'] + '" --refcat "' + POS_MODEL_CATALOGUE + '" --corrected "' + obsFiles['ipb_cat_corrected'] + '" --xm "' + obsFiles['xm'] + '" --suffix warp --infits "' + obsFiles['ipb'] + '" --ra1 ra --dec1 dec --ra2 RAJ2000 --dec2 DEJ2000 --plot --nsrcs 750 --vm 10 --progress --cores 19 --signal peak_flux_1 --enforce-min-srcs 100', shell=True, check=True)
+subprocess.run('fits_warp.py --incat "' + obsFiles['ipb_reduced_cat'] + '" --refcat "' + POS_MODEL_CATALOGUE + '" --corrected "' + obsFiles['ipb_cat_corrected'] + '" --xm "' + obsFiles['xm'] + '" --suffix warp --infits "' + obsFiles['ipb'] + f'" --ra1 ra --dec1 dec --ra2 RAJ2000 --dec2 DEJ2000 --plot --nsrcs 750 --vm 10 --progress --cores {cores} --signal peak_flux_1 --enforce-min-srcs 100', shell=True, check=True)
 
 # Flux_warp dependency, match the image catalogue to the model table.
 subprocess.run('match_catalogues "' + obsFiles['ipb_cat_corrected'] + '" "' + FLUX_MODEL_CATALOGUE + '" --separation "' + str(separation) + '" --exclusion_zone "' + str(exclusion) + '" --outname "' + obsFiles['xm'] + '" --threshold 0.5 --nmax 1000 --coords ' + str(metadata['RA']) + ' ' + str(metadata['DEC']) + ' --radius "' + str(radius) + '" --ra2 "RAJ2000" --dec2 "DEJ2000" --ra1 "ra" --dec1 "dec" -F "int_flux" --eflux "err_int_flux" --localrms "local_rms"', shell=True, check=True)
@@ -213,10 +229,10 @@ subprocess.run('flux_warp "' + obsFiles['xm'] + '" "' + obsFiles['ipb_warp'] + '
     
 
 # Calculate the RMS and BKG maps for the warped image.
-subprocess.run('BANE --cores 1 --compress "' + obsFiles['ipb_warp_scaled'] + '"', shell=True, check=True)
+subprocess.run(f'BANE --cores {cores} --compress "' + obsFiles['ipb_warp_scaled'] + '"', shell=True, check=True)
 
 # Rerun the source finding on the flux warped image.
-subprocess.run('aegean --cores=1 --autoload --table="' + obsFiles['ipb_warp_scaled'] + '" "' + obsFiles['ipb_warp_scaled'] + '"', shell=True, check=True)
+subprocess.run(f'aegean --cores={cores} --autoload --table="' + obsFiles['ipb_warp_scaled'] + '" "' + obsFiles['ipb_warp_scaled'] + '"', shell=True, check=True)
 
 # Generate a weight map for mosaicking.
 gwm.genWeightMap(obsFiles['beam_xx'], obsFiles['beam_yy'], obsFiles['ipb_warp_scaled_rms'], obsFiles['ipb_warp_scaled_weight'])
@@ -225,7 +241,8 @@ gwm.genWeightMap(obsFiles['beam_xx'], obsFiles['beam_yy'], obsFiles['ipb_warp_sc
 with fits.open(obsFiles['ipb_warp_scaled_cat']) as catHdu:
     cat = catHdu[1].data
     nsrc = len(cat)
-report.updateObs(reportCsv, obsid, 'sourcecount_' + subchan, str(nsrc))
+obsReport.update('sourcecount_' + subchan, str(nsrc))
+obsReport.commit()
 
 beamCentI = calcBeamCentre(obsFiles['ipb_warp_scaled_weight'])
 
@@ -233,22 +250,22 @@ beamCentI = calcBeamCentre(obsFiles['ipb_warp_scaled_weight'])
 # Calculate ratios for all sources.
 subprocess.run(f'match_catalogues "{obsFiles["ipb_warp_scaled_cat"]}" "{FLUX_MODEL_CATALOGUE}" --separation "{separation}" --exclusion_zone "{exclusion}" --outname "{obsFiles["i_xm"]}" --threshold 0.5 --nmax 1000 --coords {beamCentI.ra.deg} {beamCentI.dec.deg} --radius {radiusScaling} --ra2 "RAJ2000" --dec2 "DEJ2000" --ra1 "ra" --dec1 "dec" -F "int_flux" --eflux "err_int_flux" --localrms "local_rms"', shell=True, check=True)
 ratio = catCalcs.calcA(f'{obsid}_{subchan}_I', obsFiles['i_xm'], metadata['FREQCENT'], method='all')
-report.updateObs(reportCsv, obsid, f'ratio_{subchan}', ratio)
+obsReport.update(f'ratio_{subchan}', ratio)
 
 # Calculate ratios for isolated sources.
 catCalcs.reduceCat(obsFiles["ipb_warp_scaled_cat"], obsFiles["ipb_warp_reduced_cat"], distance=isolationDistance)
 subprocess.run(f'match_catalogues "{obsFiles["ipb_warp_reduced_cat"]}" "{FLUX_MODEL_CATALOGUE}" --separation "{separation}" --exclusion_zone "{exclusion}" --outname "{obsFiles["i_isolated_xm"]}" --threshold 0.5 --nmax 1000 --coords {beamCentI.ra.deg} {beamCentI.dec.deg} --radius {radiusScaling} --ra2 "RAJ2000" --dec2 "DEJ2000" --ra1 "ra" --dec1 "dec" -F "int_flux" --eflux "err_int_flux" --localrms "local_rms"', shell=True, check=True)
 ratioIso = catCalcs.calcA(f'{obsid}_{subchan}_I_isolated', obsFiles['i_isolated_xm'], metadata['FREQCENT'], method='all')
-report.updateObs(reportCsv, obsid, f'ratio_isolated_{subchan}', ratioIso)
+obsReport.update(f'ratio_isolated_{subchan}', ratioIso)
 
 
 # Calculate the thermal RMS at the center of the beam.
 obsRms = rms.calcRMSCoords(obsFiles['ipb_warp_scaled_rms'], beamCentI.ra.deg, beamCentI.dec.deg)
-report.updateObs(reportCsv, obsid, 'rms_' + subchan, str(obsRms))
+obsReport.update('rms_' + subchan, str(obsRms))
 
 # Calculate the thermal RMS at the coords specified.
 obsCoordRms = rms.calcRMSCoords(obsFiles['ipb_warp_scaled_rms'], ra, dec)
-report.updateObs(reportCsv, obsid, 'coord_rms_' + subchan, str(obsCoordRms))
-report.updateObs(reportCsv, obsid, 'postImage_' + subchan, 'Success')
+obsReport.update('coord_rms_' + subchan, str(obsCoordRms))
+obsReport.update('postImage_' + subchan, 'Success')
 if subchan == 'MFS':
-    report.updateObs(reportCsv, obsid, 'beamsize', beam.calcBeamSize(obsFiles['ipb_warp_scaled']))
+    obsReport.update('beamsize', beam.calcBeamSize(obsFiles['ipb_warp_scaled']))
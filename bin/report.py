@@ -1,89 +1,204 @@
 import os
 import sys
 import time
-import fcntl
+import signal
 import pandas as pd
+import reportLock
+import reportClient
+import reportJournal
+import reportSchema
+import reportCsv
+import reportSqlite
+import reportShards
+
+# Reports with these extensions are stored in SQLite, anything else is treated as a CSV.
+sqliteExtensions = ('.db', '.sqlite', '.sqlite3')
+# A directory, or a path with this extension, is a report sharded by night or obsid range.
+shardExtension = '.shards'
 
 def clearLock(lockFile):
-    with open(lockFile, 'w+') as filelock:
-        filelock.write('Available')
-
-def setLock(lockFile, obsid):
-    if not os.path.exists(lockFile):
-        clearLock(lockFile)
-    with open(lockFile, 'r') as filelock:
-        contents = filelock.read()
-    if contents == 'Available':
-        with open(lockFile, 'w') as filelock:
-            filelock.write(f'{obsid}')
-        return True
-    else:
-        return False
+    reportLock.clearLock(lockFile)
 
-def checkLock(lockFile, obsid):
-    with open(lockFile, 'r') as filelock:
-        contents = filelock.read()
-    if contents == obsid:
-        return True
-    else:
-        return False
+
+# Return the backend for the report based on the file extension.
+def getBackend(reportFile):
+    if os.path.isdir(reportFile) or reportFile.rstrip(os.sep).endswith(shardExtension):
+        return reportShards.ShardedReport(reportFile)
+    if os.path.splitext(reportFile)[1].lower() in sqliteExtensions:
+        return reportSqlite.SqliteReport(reportFile)
+    return reportCsv.CsvReport(reportFile)
+
+
+# Read the full report as a dataframe indexed by obsid with string values.
+def readReport(reportFile):
+    return getBackend(reportFile).read()
+
+
+# Counts of observations by status, job_status and jobid maintained by each write, see reportSummary.statusCounts.
+def readSummary(reportFile, refresh=False):
+    return getBackend(reportFile).summary(refresh=refresh)
+
+
+# Typed Parquet snapshot of the report stored next to it, used for fast queries without parsing the report.
+def snapshotFile(reportFile):
+    return os.path.splitext(reportFile.rstrip(os.sep))[0] + '.parquet'
+
+# Time the report was last changed, including the SQLite write-ahead log and every shard of a sharded report.
+def reportModified(reportFile):
+    files = [reportFile, reportFile + '-wal']
+    if os.path.isdir(reportFile):
+        files = [file for shard in reportShards.ShardedReport(reportFile).shardFiles() for file in [shard, shard + '-wal']]
+    return max((os.path.getmtime(file) for file in files if os.path.exists(file)), default=0)
+
+# Rebuild the typed snapshot from the report and return the typed report.
+def writeSnapshot(reportFile, reportDF=None):
+    if reportDF is None:
+        reportDF = readReport(reportFile)
+    typed = reportSchema.typedReport(reportDF)
+    snapshot = snapshotFile(reportFile)
+    try:
+        typed.to_parquet(snapshot + '.tmp')
+        os.replace(snapshot + '.tmp', snapshot)
+    except ImportError:
+        print('Unable to write the report snapshot, pyarrow is not installed.')
+    return typed
+
+# Read the typed report, from the snapshot if it is up to date, otherwise rebuilding the snapshot.
+def readTypedReport(reportFile):
+    snapshot = snapshotFile(reportFile)
+    if os.path.exists(snapshot) and os.path.getmtime(snapshot) >= reportModified(reportFile):
+        try:
+            return pd.read_parquet(snapshot)
+        except ImportError:
+            pass
+    return writeSnapshot(reportFile)
+
+
+# Copy the contents of one report to another, converting between CSV, SQLite and sharded reports as required.
+# shardConfig, e.g. {'scheme': 'range', 'rangeSize': 100000}, sets up the destination when it is a new sharded report.
+def convertReport(srcFile, dstFile, shardConfig=None):
+    report = readReport(srcFile)
+    backend = getBackend(dstFile)
+    if isinstance(backend, reportShards.ShardedReport) and not os.path.exists(os.path.join(dstFile, reportShards.configName)):
+        backend.create(**(shardConfig or {}))
+    backend.write(report)
+    return len(report.index)
 
 
 def updateObs(reportFile, obsid, action, val, quiet=False):
+    updateObsMany(reportFile, obsid, {action: val}, quiet=quiet)
+
+
+# Update several columns for an observation with a single locked read-modify-write of the report.
+def updateObsMany(reportFile, obsid, values, quiet=False):
     obsid = str(obsid)
     obsid = obsid[0:10]
 
-    # Create a lock file in the same directory as the report.
-    lockFile = os.path.join(os.path.dirname(reportFile), '.lock')
+    if len(values) == 0:
+        return
+
+    if not quiet:
+        for action, val in values.items():
+            print(f'Updating Report - ObsID: {obsid} - Action: {action} - Value: {val}')
+
+    # If a report server is running, send the update to it, falling back to the report file if it is unavailable.
+    serverAddress = reportClient.serverAddress()
+    if serverAddress != '':
+        if reportClient.updateObsMany(serverAddress, reportFile, obsid, values):
+            return
+
+    # With journalling enabled, record the update without touching the report, it is merged later by manageReport.py verify.
+    journalDir = reportJournal.journalDir()
+    if journalDir != '':
+        reportJournal.append(journalDir, obsid, values)
+        return
+
+    reportUpdated = getBackend(reportFile).update(obsid, dict(values))
+
+    if (reportUpdated == False):
+        print('Report Update Unsuccessful.')
+
+
+# Update many observations, {obsid: {action: val}}, with a single locked read-modify-write of the report.
+def updateMultipleObs(reportFile, updates, quiet=True):
+    updates = {str(obsid)[0:10]: values for obsid, values in updates.items() if len(values) > 0}
+    if len(updates) == 0:
+        return True
 
-    # Attempt to obtain exclusive access to the report every 5 seconds for 10 minutes.
-    reportUpdated = False
     if not quiet:
-        print(f'Updating Report - ObsID: {obsid} - Action: {action} - Value: {val}')
-    for i in range(120):
-        if setLock(lockFile, obsid):
-            if not checkLock(lockFile, obsid): # Check to make sure the lock is correct.
-                continue
-            # Open and update the report.
-            #report = pd.read_csv(reportFile, dtype=str, index_col='obsid')
-            report = pd.read_csv(reportFile, dtype=str)
-            #report.index = report.index.map(str)
-            report['obsid'] = report['obsid'].apply(str)
-            report['obsid'] = report['obsid'].str.slice(0,10)
-            report.set_index('obsid', inplace=True)
-
-            # Check to ensure the column exists, if not, create it.
-            if action not in report.columns:
-                report[action] = ''
-                
-            report.at[obsid, action] = val
-            report.to_csv(reportFile)
-            reportUpdated = True
-            clearLock(lockFile)
-            break
-        else:
-            time.sleep(5) 
+        for obsid, values in updates.items():
+            for action, val in values.items():
+                print(f'Updating Report - ObsID: {obsid} - Action: {action} - Value: {val}')
+
+    reportUpdated = getBackend(reportFile).updateRows(updates)
 
     if (reportUpdated == False):
         print('Report Update Unsuccessful.')
+    return reportUpdated
+
+
+# Fold all task journals into the report in one pass, keeping the last write for each column.
+# Returns the number of observations updated.
+def mergeJournals(reportFile, journalDir):
+    files = reportJournal.claim(reportJournal.findJournals(journalDir))
+    if len(files) == 0:
+        return 0
+
+    updates = reportJournal.fold(reportJournal.readEvents(files))
+    if not updateMultipleObs(reportFile, updates):
+        return 0
+
+    reportJournal.archive(journalDir, files)
+    return len(updates)
+
+
+# Collect the report updates for an observation and write them together on commit.
+# Can be used as a context manager, the updates are committed when the block exits.
+class Transaction:
+    def __init__(self, reportFile, obsid, quiet=False):
+        self.reportFile = reportFile
+        self.obsid = obsid
+        self.quiet = quiet
+        self.values = {}
+
+    def update(self, action, val):
+        self.values[action] = val
+
+    def updateMany(self, values):
+        self.values.update(values)
+
+    def commit(self):
+        values = self.values
+        self.values = {}
+        updateObsMany(self.reportFile, self.obsid, values, quiet=self.quiet)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.commit()
+        return False
+
+
+def transaction(reportFile, obsid, quiet=False):
+    return Transaction(reportFile, obsid, quiet=quiet)
+
+# Exit through the atexit handlers on SIGTERM, e.g. when Slurm or Nextflow stops a task, so a transaction committed at exit is still written.
+# SIGKILL can not be handled, so the scripts also commit their transaction at their milestones.
+def commitOnTerminate():
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
 
 
 def startObs(reportFile, obsid, obsDir):
     obsid = str(obsid)
     obsid = obsid[0:10]
 
-    report = pd.read_csv(reportFile, dtype=str)
+    report = readReport(reportFile)
     print('Successfully Opened and Read Report.')
-    report['obsid'] = report['obsid'].apply(str)
-    report['obsid'] = report['obsid'].str.slice(0,10)
-    report.set_index('obsid', inplace=True)
 
     attempts = 0
     if 'attempts' in report.columns:
         attempts = int(report.at[obsid, 'attempts'])
     attempts += 1
 
-    updateObs(reportFile, obsid, 'attemps', attempts)
-    updateObs(reportFile, obsid, 'status', 'Queued')
-    updateObs(reportFile, obsid, 'obsDir', obsDir)
-    
\ No newline at end of file
+    updateObsMany(reportFile, obsid, {'attemps': attempts, 'status': 'Queued', 'obsDir': obsDir})
@@ -0,0 +1,94 @@
+import os
+import json
+import stat
+import socket
+import secrets
+
+# When this environment variable is set to the address of a running reportServer.py, report updates are sent
+# to the server instead of being written to the report file. Addresses are either host:port or unix:/path/to/socket.
+# Every request carries the shared secret the server writes to the .server_token file next to the report, readable only by its owner.
+serverEnv = 'DIP_REPORT_SERVER'
+serverTimeout = 10
+tokenSuffix = '.server_token'
+
+
+# Return the report server address if one is configured, otherwise an empty string.
+def serverAddress():
+    return os.environ.get(serverEnv, '').strip()
+
+# Split an address into the socket family and the address to connect or bind to.
+def parseAddress(address):
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[5:]
+    if '/' in address:
+        return socket.AF_UNIX, address
+    host, port = address.rsplit(':', 1)
+    return socket.AF_INET, (host, int(port))
+
+def tokenFile(reportFile):
+    return os.path.splitext(reportFile.rstrip(os.sep))[0] + tokenSuffix
+
+# Write a new token for the server, the file is created with 0600 permissions and replaces any previous token.
+def writeToken(reportFile):
+    file = tokenFile(reportFile)
+    token = secrets.token_hex(32)
+    if os.path.exists(file + '.tmp'):
+        os.remove(file + '.tmp')
+    fd = os.open(file + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token)
+    os.replace(file + '.tmp', file)
+    return token
+
+# Read the token, refusing one which other users could read or write. Returns None if there is no usable token.
+def readToken(reportFile):
+    file = tokenFile(reportFile)
+    try:
+        with open(file, 'r') as f:
+            if stat.S_IMODE(os.fstat(f.fileno()).st_mode) & 0o077:
+                print(f'Ignoring {file}, it must only be accessible by its owner (chmod 600).')
+                return None
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+# Convert numpy scalars to python types so they can be sent as JSON.
+def toJson(val):
+    if hasattr(val, 'item'):
+        val = val.item()
+    if val is None or isinstance(val, (str, int, float, bool)):
+        return val
+    return str(val)
+
+
+# Send a single request to the server and return the response. Raises OSError if the server can not be reached.
+def request(address, message, timeout=serverTimeout):
+    family, addr = parseAddress(address)
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(addr)
+        sock.sendall((json.dumps(message) + '\n').encode())
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile('r') as f:
+            line = f.readline()
+    if line == '':
+        raise ConnectionError(f'No response from the report server at {address}.')
+    return json.loads(line)
+
+
+# Send the updates for an observation to the server, returns False if the server is unavailable or rejects them.
+def updateObsMany(address, reportFile, obsid, values):
+    token = readToken(reportFile)
+    if token is None:
+        print(f'Report server token {tokenFile(reportFile)} unavailable.')
+        return False
+    message = dict(op='update', token=token, obsid=str(obsid)[0:10], values={action: toJson(val) for action, val in values.items()})
+    try:
+        response = request(address, message)
+    except (OSError, ValueError) as e:
+        print(f'Report server unavailable at {address}: {e}')
+        return False
+    if not response.get('ok', False):
+        print(f'Report server at {address} rejected the update: {response.get("error")}')
+    return response.get('ok', False)
@@ -0,0 +1,78 @@
+import os
+import pandas as pd
+import reportLock
+import reportSummary
+
+
+# Report stored as a CSV, every update rewrites the whole file while holding the .lock file.
+class CsvReport:
+    def __init__(self, reportFile, lockFile=None, create=False):
+        self.reportFile = reportFile
+        # Start a new report on the first update if the file does not exist, used for the shards of a sharded report.
+        self.create = create
+        # Create a lock file in the same directory as the report.
+        if lockFile is None:
+            lockFile = os.path.join(os.path.dirname(reportFile), '.lock')
+        self.lockFile = lockFile
+
+    def read(self):
+        report = pd.read_csv(self.reportFile, dtype=str)
+        report['obsid'] = report['obsid'].apply(str)
+        report['obsid'] = report['obsid'].str.slice(0,10)
+        report.set_index('obsid', inplace=True)
+        return report
+
+    def write(self, report):
+        report.index.name = 'obsid'
+        report.to_csv(self.reportFile)
+
+    def update(self, obsid, values):
+        return self.updateRows({obsid: values})
+
+    # Apply the updates for many observations, {obsid: {action: val}}, in a single locked read-modify-write.
+    def updateRows(self, updates, owner='report'):
+        if len(updates) == 1:
+            owner = next(iter(updates))
+        # Wait for exclusive access to the report, by default for up to 10 minutes.
+        lock = reportLock.ReportLock(self.lockFile, owner)
+        if not lock.acquire():
+            print(f'Timed out after {lock.waited:.1f} seconds waiting for the report lock.')
+            return False
+        try:
+            reportLock.logWait(self.lockFile, owner, lock.waited)
+            if self.create and not os.path.exists(self.reportFile):
+                pd.DataFrame(columns=['obsid']).to_csv(self.reportFile, index=False)
+            # Open and update the report.
+            counts = reportSummary.readSummary(self.reportFile)
+            report = self.read()
+            for obsid, values in updates.items():
+                oldKey = None
+                if obsid in report.index:
+                    oldKey = reportSummary.rowKey(report.loc[obsid])
+                for action, val in values.items():
+                    # Check to ensure the column exists, if not, create it.
+                    if action not in report.columns:
+                        report[action] = ''
+                    report.at[obsid, action] = val
+                if counts is not None:
+                    reportSummary.applyChange(counts, oldKey, reportSummary.rowKey(report.loc[obsid]))
+            self.write(report)
+            # Keep the status summary in step with the report, rebuilding it if it was missing or out of date.
+            if counts is None:
+                counts = reportSummary.buildCounts(report)
+            reportSummary.writeSummary(self.reportFile, counts)
+        finally:
+            lock.release()
+        return True
+
+    # Counts of observations by status, job_status and jobid, rebuilt from the report if out of date.
+    def summary(self, refresh=False):
+        counts = None
+        if not refresh:
+            counts = reportSummary.readSummary(self.reportFile)
+        if counts is not None:
+            return counts
+        with reportLock.ReportLock(self.lockFile, 'summary'):
+            counts = reportSummary.buildCounts(self.read())
+            reportSummary.writeSummary(self.reportFile, counts)
+        return counts
@@ -0,0 +1,112 @@
+import os
+import sys
+import glob
+import json
+import time
+import fcntl
+import shutil
+import socket
+
+# When this environment variable is set to a directory, report updates are appended to a journal in that
+# directory instead of being written to the report. manageReport.py verify merges the journals into the report.
+journalEnv = 'DIP_REPORT_JOURNAL'
+journalExtension = '.jsonl'
+mergedDir = 'merged'
+
+
+# Return the journal directory if journalling is enabled, otherwise an empty string.
+def journalDir():
+    return os.environ.get(journalEnv, '').strip()
+
+# Each task writes to its own journal so tasks never contend for a file.
+def journalFile(directory, obsid):
+    return os.path.join(directory, f'{obsid}_{socket.gethostname()}_{os.getpid()}{journalExtension}')
+
+# The stage is the name of the script making the update, e.g. calibrate, image or postImage.
+def currentStage():
+    return os.path.splitext(os.path.basename(sys.argv[0]))[0]
+
+# Convert numpy scalars to python types so they can be written as JSON.
+def toJson(val):
+    if hasattr(val, 'item'):
+        val = val.item()
+    if val is None or isinstance(val, (str, int, float, bool)):
+        return val
+    return str(val)
+
+
+# Append an event per column to the journal for the task.
+def append(directory, obsid, values, stage=None):
+    if stage is None:
+        stage = currentStage()
+    timestamp = time.time()
+    lines = []
+    for action, val in values.items():
+        event = dict(obsid=obsid, column=action, value=toJson(val), timestamp=timestamp, stage=stage)
+        lines.append(json.dumps(event) + '\n')
+
+    os.makedirs(directory, exist_ok=True)
+    file = journalFile(directory, obsid)
+    while True:
+        with open(file, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # If the journal was taken for merging while waiting for the lock, start a new one.
+            if not os.path.exists(file) or os.stat(file).st_ino != os.fstat(f.fileno()).st_ino:
+                continue
+            # Write all events in a single append so a partially written update is never left behind.
+            f.write(''.join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+            return
+
+
+# Journals waiting to be merged into the report, including any left claimed by an interrupted merge.
+def findJournals(directory):
+    files = glob.glob(os.path.join(directory, '*' + journalExtension))
+    files += glob.glob(os.path.join(directory, '*' + journalExtension + '.merging'))
+    return sorted(files)
+
+# Take the journals for merging by renaming them, new updates from running tasks will go to new journals.
+# Waiting on each journal's lock ensures any append in progress has finished before it is read.
+def claim(files):
+    claimed = []
+    for file in files:
+        claimedFile = file
+        if not file.endswith('.merging'):
+            claimedFile = file + '.merging'
+            try:
+                os.rename(file, claimedFile)
+            except FileNotFoundError:
+                continue
+        with open(claimedFile, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        claimed.append(claimedFile)
+    return claimed
+
+# Read all events from the journals, skipping any incomplete line from a task that was killed mid write.
+def readEvents(files):
+    events = []
+    for file in files:
+        with open(file, 'r') as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except json.JSONDecodeError:
+                    print(f'Skipping incomplete journal entry in {file}')
+    return events
+
+# Fold the events into {obsid: {column: val}}, keeping the last write for each column.
+def fold(events):
+    updates = {}
+    for event in sorted(events, key=lambda event: event['timestamp']):
+        updates.setdefault(str(event['obsid'])[0:10], {})[event['column']] = event['value']
+    return updates
+
+# Move merged journals aside so they are not applied again, keeping them as a replayable history of the updates.
+def archive(directory, files):
+    archiveDir = os.path.join(directory, mergedDir)
+    os.makedirs(archiveDir, exist_ok=True)
+    mergeTime = time.strftime('%Y%m%d%H%M%S')
+    for file in files:
+        name = os.path.basename(file).replace(journalExtension + '.merging', '')
+        shutil.move(file, os.path.join(archiveDir, f'{name}_{mergeTime}{journalExtension}'))
@@ -0,0 +1,204 @@
+import os
+import time
+import errno
+import fcntl
+import socket
+
+# Default time to wait for the lock before giving up, and the polling interval while waiting.
+lockTimeout = 600
+lockPoll = 0.05
+lockPollMax = 0.5
+# A fallback lock older than this is considered stale even if the holder cannot be checked.
+staleLockAge = 3600
+# The lock wait log is rotated to .1 when it reaches this size.
+waitLogMaxBytes = 10 * 1024**2
+
+# Lock wait time statistics for this process.
+lockStats = dict(acquired=0, timeouts=0, staleCleared=0, waitTotal=0.0, waitMax=0.0)
+
+
+# Description of the current process written into the lock so other tasks can see who holds it.
+def holderInfo(owner):
+    return f'{socket.gethostname()} {os.getpid()} {time.time():.3f} {owner}'
+
+# Parse the holder information written by holderInfo, returns None if it can not be read.
+def readHolder(heldFile):
+    try:
+        with open(heldFile, 'r') as f:
+            host, pid, started = f.read().split()[0:3]
+        return host, int(pid), float(started)
+    except (OSError, ValueError):
+        return None
+
+# Check if the process holding a lock is still alive. Only possible when it is on the same host.
+def holderAlive(host, pid):
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+# A fallback lock is stale if the holder process has gone or it has been held for longer than staleLockAge.
+def isStale(heldFile, maxAge=staleLockAge):
+    holder = readHolder(heldFile)
+    if holder is None:
+        # Holder may be part way through writing its details, fall back to the file age.
+        try:
+            return time.time() - os.path.getmtime(heldFile) > maxAge
+        except OSError:
+            return False
+    host, pid, started = holder
+    if time.time() - started > maxAge:
+        return True
+    return not holderAlive(host, pid)
+
+
+# Exclusive lock on the report using flock on the .lock file.
+# The kernel releases the lock if the holder crashes so it can never be left held by a dead task.
+# Where flock is not supported by the filesystem an atomically created .held file is used instead,
+# which is removed automatically if the holder is found to be dead or has held it for too long.
+class ReportLock:
+    def __init__(self, lockFile, owner='', timeout=lockTimeout):
+        self.lockFile = lockFile
+        self.heldFile = lockFile + '.held'
+        self.owner = owner
+        self.timeout = timeout
+        self.fd = None
+        self.useFlock = True
+        self.waited = 0.0
+
+    def tryFlock(self):
+        if self.fd is None:
+            self.fd = os.open(self.lockFile, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as e:
+            if e.errno in (errno.EWOULDBLOCK, errno.EAGAIN, errno.EACCES):
+                return False
+            # Filesystem does not support flock, switch to the fallback lock.
+            os.close(self.fd)
+            self.fd = None
+            self.useFlock = False
+            return self.tryHeldFile()
+        os.ftruncate(self.fd, 0)
+        os.pwrite(self.fd, holderInfo(self.owner).encode(), 0)
+        return True
+
+    def createHeldFile(self):
+        try:
+            fd = os.open(self.heldFile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(holderInfo(self.owner))
+        return True
+
+    def tryHeldFile(self):
+        if self.createHeldFile():
+            return True
+        if self.clearStaleHeldFile():
+            return self.createHeldFile()
+        return False
+
+    # Take over a stale fallback lock, returns True if it was removed.
+    # The lock is renamed to a name unique to this process so only one task can take it, and it is only deleted if it is
+    # still the file which was found to be stale. If another task replaced it in the meantime, its lock is linked back.
+    def clearStaleHeldFile(self):
+        def identity():
+            stat = os.stat(self.heldFile)
+            return stat.st_dev, stat.st_ino, stat.st_mtime_ns
+        try:
+            staleIdentity = identity()
+            if not isStale(self.heldFile) or identity() != staleIdentity:
+                return False
+            takenFile = f'{self.heldFile}.{socket.gethostname()}.{os.getpid()}'
+            os.rename(self.heldFile, takenFile)
+        except FileNotFoundError:
+            return False
+
+        takenStat = os.stat(takenFile)
+        if (takenStat.st_dev, takenStat.st_ino, takenStat.st_mtime_ns) != staleIdentity:
+            try:
+                os.link(takenFile, self.heldFile)
+            except FileExistsError:
+                pass
+            os.remove(takenFile)
+            return False
+
+        print(f'Removing stale report lock: {self.heldFile}')
+        lockStats['staleCleared'] += 1
+        os.remove(takenFile)
+        return True
+
+    def tryAcquire(self):
+        if self.useFlock:
+            return self.tryFlock()
+        return self.tryHeldFile()
+
+    # Block until the lock is obtained or the timeout is reached, backing off from lockPoll to lockPollMax.
+    def acquire(self):
+        start = time.monotonic()
+        poll = lockPoll
+        while True:
+            if self.tryAcquire():
+                self.waited = time.monotonic() - start
+                lockStats['acquired'] += 1
+                lockStats['waitTotal'] += self.waited
+                lockStats['waitMax'] = max(lockStats['waitMax'], self.waited)
+                return True
+            if time.monotonic() - start >= self.timeout:
+                self.waited = time.monotonic() - start
+                lockStats['timeouts'] += 1
+                return False
+            time.sleep(poll)
+            poll = min(poll * 2, lockPollMax)
+
+    def release(self):
+        if self.useFlock:
+            if self.fd is not None:
+                os.ftruncate(self.fd, 0)
+                os.pwrite(self.fd, b'Available', 0)
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+                os.close(self.fd)
+                self.fd = None
+        else:
+            try:
+                os.remove(self.heldFile)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        if not self.acquire():
+            raise TimeoutError(f'Unable to obtain the report lock {self.lockFile} after {self.timeout} seconds.')
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.release()
+        return False
+
+
+# Append the time waited for the lock to a log next to the lock file, must be called while holding the lock.
+# Once the log reaches waitLogMaxBytes it replaces the previous log, .lock_waits.csv.1, and a new log is started.
+def logWait(lockFile, owner, waited):
+    waitLog = lockFile + '_waits.csv'
+    if os.path.exists(waitLog) and os.path.getsize(waitLog) >= waitLogMaxBytes:
+        os.replace(waitLog, waitLog + '.1')
+    newLog = not os.path.exists(waitLog)
+    with open(waitLog, 'a') as f:
+        if newLog:
+            f.write('time,host,pid,obsid,wait\n')
+        f.write(f'{time.time():.3f},{socket.gethostname()},{os.getpid()},{owner},{waited:.3f}\n')
+
+
+# Remove any fallback lock and reset the lock file, used by clearLock.py to recover by hand.
+def clearLock(lockFile):
+    try:
+        os.remove(lockFile + '.held')
+    except FileNotFoundError:
+        pass
+    with open(lockFile, 'w+') as filelock:
+        filelock.write('Available')
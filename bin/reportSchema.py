@@ -0,0 +1,49 @@
+import pandas as pd
+
+# Column name prefixes which hold numeric metrics.
+realColumns = ('rms_', 'coord_rms_', 'Axx_', 'Ayy_', 'ratio_', 'beamsize')
+integerColumns = ('attempts', 'attemps')
+# Source counts are recorded as 'Initial - N' before flux scaling and N afterwards.
+sourceCountColumns = ('sourcecount_', 'uvSub_SourceCount')
+sourceCountInitial = 'Initial - '
+# Suffixes of the stage timing columns recorded by stageTiming.
+timingRealColumns = ('_wall_s', '_cpu_s', '_maxrss_mb')
+timingTimeColumns = ('_start', '_end')
+
+
+# Return the type of a report column, 'real', 'integer', 'sourcecount', 'time' or 'text'.
+def columnKind(name):
+    if name.endswith(timingRealColumns):
+        return 'real'
+    if name.endswith(timingTimeColumns):
+        return 'time'
+    if name.startswith(integerColumns):
+        return 'integer'
+    if name.startswith(realColumns):
+        return 'real'
+    if name.startswith(sourceCountColumns):
+        return 'sourcecount'
+    return 'text'
+
+
+# Convert the report, as read with string values, into typed columns.
+# Source counts become an integer column with a boolean <column>_initial column marking counts before flux scaling.
+def typedReport(reportDF):
+    typed = pd.DataFrame(index=reportDF.index.astype(str))
+    typed.index.name = 'obsid'
+    for col in reportDF.columns:
+        values = reportDF[col]
+        kind = columnKind(col)
+        if kind == 'real':
+            typed[col] = pd.to_numeric(values, errors='coerce').astype('float64')
+        elif kind == 'integer':
+            typed[col] = pd.to_numeric(values, errors='coerce').astype('Int64')
+        elif kind == 'time':
+            typed[col] = pd.to_datetime(values, utc=True, errors='coerce')
+        elif kind == 'sourcecount':
+            values = values.astype('string')
+            typed[col] = pd.to_numeric(values.str.replace(sourceCountInitial, '', regex=False), errors='coerce').astype('Int64')
+            typed[col + '_initial'] = values.str.startswith(sourceCountInitial).astype('boolean')
+        else:
+            typed[col] = values.astype('string')
+    return typed
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import hmac
+import json
+import signal
+import socket
+import threading
+import socketserver
+import report
+import reportClient
+
+
+# Long running report server, started alongside Nextflow by dip.sbatch.
+# The report is held in memory and updates from the processing tasks are applied serially without any file locking.
+# Updates are checkpointed to the report file periodically and when the server is stopped with SIGTERM.
+# Requests must carry the token written to the .server_token file next to the report when the server starts, see reportClient.
+# Usage: reportServer.py reportFile address [checkpointInterval]
+#   address is host:port, bound to the interface of host, or unix:/path/to/socket for tasks on the same node.
+
+checkpointInterval = 60
+
+
+class ReportState:
+    def __init__(self, reportFile):
+        self.reportFile = reportFile
+        self.lock = threading.Lock()
+        self.rows = {}
+        self.dirty = {}
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.reportFile):
+            return
+        reportDF = report.readReport(self.reportFile)
+        for obsid, row in reportDF.iterrows():
+            self.rows[str(obsid)] = {action: val for action, val in row.items() if isinstance(val, str)}
+        print(f'Loaded {len(self.rows)} observations from {self.reportFile}')
+
+    def update(self, obsid, values):
+        with self.lock:
+            self.rows.setdefault(obsid, {}).update(values)
+            self.dirty.setdefault(obsid, {}).update(values)
+
+    def get(self, obsid):
+        with self.lock:
+            return dict(self.rows.get(obsid, {}))
+
+    # Write the updates received since the last checkpoint to the report file in one locked write.
+    def checkpoint(self):
+        with self.lock:
+            dirty = self.dirty
+            self.dirty = {}
+        if len(dirty) == 0:
+            return 0
+        if not report.updateMultipleObs(self.reportFile, dirty):
+            # Keep the updates to retry at the next checkpoint, newer values take precedence.
+            with self.lock:
+                for obsid, values in dirty.items():
+                    self.dirty[obsid] = {**values, **self.dirty.get(obsid, {})}
+            return 0
+        return len(dirty)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            message = json.loads(self.rfile.readline())
+            response = self.server.dispatch(message)
+        except Exception as e:
+            response = dict(ok=False, error=str(e))
+        self.wfile.write((json.dumps(response) + '\n').encode())
+
+
+class ServerMixin:
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def dispatch(self, message):
+        if not hmac.compare_digest(str(message.get('token', '')), self.token):
+            return dict(ok=False, error='Invalid token')
+        op = message.get('op')
+        if op == 'update':
+            self.state.update(str(message['obsid'])[0:10], message['values'])
+            return dict(ok=True)
+        if op == 'get':
+            return dict(ok=True, values=self.state.get(str(message['obsid'])[0:10]))
+        if op == 'checkpoint':
+            return dict(ok=True, count=self.state.checkpoint())
+        if op == 'ping':
+            return dict(ok=True)
+        return dict(ok=False, error=f'Unknown operation: {op}')
+
+
+class TCPReportServer(ServerMixin, socketserver.ThreadingTCPServer):
+    pass
+
+
+class UnixReportServer(ServerMixin, socketserver.ThreadingUnixStreamServer):
+    pass
+
+
+def createServer(reportFile, address):
+    family, addr = reportClient.parseAddress(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(addr):
+            os.remove(addr)
+        server = UnixReportServer(addr, RequestHandler)
+        os.chmod(addr, 0o600)
+    else:
+        server = TCPReportServer(addr, RequestHandler)
+    server.state = ReportState(reportFile)
+    server.token = reportClient.writeToken(reportFile)
+    return server
+
+
+# Checkpoint the report every interval seconds until the server stops.
+def checkpointLoop(server, interval, stopped):
+    while not stopped.wait(interval):
+        count = server.state.checkpoint()
+        if count > 0:
+            print(f'Checkpointed {count} observations.')
+
+
+def run(reportFile, address, interval=checkpointInterval):
+    server = createServer(reportFile, address)
+    stopped = threading.Event()
+    checkpointer = threading.Thread(target=checkpointLoop, args=(server, interval, stopped), daemon=True)
+    checkpointer.start()
+
+    # Shut down cleanly on SIGTERM, e.g. when the Slurm job ends or dip.sbatch stops the server.
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+
+    print(f'Report server listening on {address}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stopped.set()
+        server.server_close()
+        count = server.state.checkpoint()
+        print(f'Report server stopped, checkpointed {count} observations.')
+        family, addr = reportClient.parseAddress(address)
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.remove(addr)
+        if os.path.exists(reportClient.tokenFile(reportFile)):
+            os.remove(reportClient.tokenFile(reportFile))
+
+
+if __name__ == '__main__':
+    if not (len(sys.argv) == 3 or len(sys.argv) == 4):
+        print('ERROR: Incorrect number of parameters.')
+        exit(-1)
+
+    interval = checkpointInterval
+    if len(sys.argv) == 4:
+        interval = float(sys.argv[3])
+
+    run(sys.argv[1], sys.argv[2], interval)
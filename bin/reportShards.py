@@ -0,0 +1,115 @@
+import os
+import json
+import glob
+import numpy as np
+import pandas as pd
+import reportCsv
+import reportSqlite
+
+# A sharded report is a directory of reports, each holding the observations for one night or one obsid range.
+# The directory contains shards.json describing how the observations are split:
+#   scheme - 'night' for one shard per night or 'range' for one shard per rangeSize obsids.
+#   format - 'csv' or 'db' (SQLite) for the shard files.
+configName = 'shards.json'
+shardPrefix = 'dip_report_'
+defaultConfig = dict(scheme='night', rangeSize=1000000, format='csv')
+
+
+# Night of each obsid as a date string, converting from GPS time in the same way as flagTiles.convGPS.
+# MWA observes between roughly 10:00 and 22:00 UTC so the UTC date identifies the night.
+# astropy is imported here as report.py, and so this module, is loaded by every processing task.
+def obsNights(obsids):
+    from astropy.time import Time
+    times = Time(np.array([float(obsid) for obsid in obsids]), format='gps')
+    return [str(dt.date()) for dt in np.atleast_1d(times.utc.datetime)]
+
+
+class ShardedReport:
+    def __init__(self, directory):
+        self.directory = directory
+        self.config = dict(defaultConfig)
+        configFile = os.path.join(directory, configName)
+        if os.path.exists(configFile):
+            with open(configFile, 'r') as f:
+                self.config.update(json.load(f))
+
+    # Create the directory and its configuration, used when a report is converted to a sharded report.
+    def create(self, scheme=None, rangeSize=None, format=None):
+        if scheme is not None:
+            self.config['scheme'] = scheme
+        if rangeSize is not None:
+            self.config['rangeSize'] = int(rangeSize)
+        if format is not None:
+            self.config['format'] = format
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, configName), 'w') as f:
+            json.dump(self.config, f, indent=4)
+
+    # Name of the shard holding each obsid.
+    def shardNames(self, obsids):
+        obsids = [str(obsid)[0:10] for obsid in obsids]
+        if len(obsids) == 0:
+            return []
+        if self.config['scheme'] == 'range':
+            size = int(self.config['rangeSize'])
+            return [str(int(obsid) // size * size) for obsid in obsids]
+        return obsNights(obsids)
+
+    def shardFile(self, name):
+        return os.path.join(self.directory, f'{shardPrefix}{name}.{self.config["format"]}')
+
+    def shardBackend(self, file):
+        if self.config['format'] == 'db':
+            return reportSqlite.SqliteReport(file)
+        # Each shard has its own hidden lock so updates to different shards never wait on each other.
+        lockFile = os.path.join(os.path.dirname(file), '.' + os.path.basename(file) + '.lock')
+        return reportCsv.CsvReport(file, lockFile=lockFile, create=True)
+
+    def shardFiles(self):
+        return sorted(glob.glob(os.path.join(self.directory, f'{shardPrefix}*.{self.config["format"]}')))
+
+    # Group updates, {obsid: values}, by the shard file they belong in.
+    def groupByShard(self, updates):
+        obsids = list(updates.keys())
+        grouped = {}
+        for obsid, name in zip(obsids, self.shardNames(obsids)):
+            grouped.setdefault(self.shardFile(name), {})[obsid] = updates[obsid]
+        return grouped
+
+    # Read all shards into a single report.
+    def read(self):
+        shards = [self.shardBackend(file).read() for file in self.shardFiles()]
+        if len(shards) == 0:
+            report = pd.DataFrame(columns=['obsid']).set_index('obsid')
+        else:
+            report = pd.concat(shards, sort=False)
+        report.index.name = 'obsid'
+        return report
+
+    # Split the report into shards, replacing the contents of each shard written.
+    def write(self, report):
+        os.makedirs(self.directory, exist_ok=True)
+        names = self.shardNames(report.index)
+        for name, shard in report.groupby(pd.Index(names, name='shard'), sort=False):
+            # Drop the columns which have no values in this shard.
+            shard = shard.dropna(axis=1, how='all')
+            self.shardBackend(self.shardFile(name)).write(shard)
+
+    def update(self, obsid, values):
+        return self.updateRows({obsid: values})
+
+    # Only the shards holding the updated observations are read and written.
+    def updateRows(self, updates):
+        os.makedirs(self.directory, exist_ok=True)
+        updated = True
+        for file, shardUpdates in self.groupByShard(updates).items():
+            updated = self.shardBackend(file).updateRows(shardUpdates) and updated
+        return updated
+
+    # Combine the status summaries of all shards.
+    def summary(self, refresh=False):
+        counts = {}
+        for file in self.shardFiles():
+            for key, count in self.shardBackend(file).summary(refresh=refresh).items():
+                counts[key] = counts.get(key, 0) + count
+        return counts
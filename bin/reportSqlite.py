@@ -0,0 +1,195 @@
+import json
+import sqlite3
+import pandas as pd
+import reportSchema
+import reportSummary
+
+tableName = 'report'
+summaryTable = 'summary'
+
+
+# Quote a column name so any report column can be used as an SQL identifier.
+def quote(name):
+    name = str(name).replace('"', '""')
+    return f'"{name}"'
+
+# Return the SQLite type to use for a report column.
+def columnType(name):
+    if name == 'obsid':
+        return 'TEXT PRIMARY KEY'
+    kind = reportSchema.columnKind(name)
+    if kind == 'integer':
+        return 'INTEGER'
+    if kind == 'real':
+        return 'REAL'
+    return 'TEXT'
+
+# Convert numpy scalars to python types so sqlite3 can bind them.
+def toSql(val):
+    if hasattr(val, 'item'):
+        val = val.item()
+    if val is None or isinstance(val, (str, int, float)):
+        return val
+    return str(val)
+
+# Convert a value read from the database to match the CSV report, strings with missing values as NaN.
+def toStr(val):
+    if val is None or val == '':
+        return float('nan')
+    return str(val)
+
+
+# Report stored in a WAL mode SQLite database, one row per obsid.
+# Updates are single row upserts so writers never rewrite the whole report and readers are not blocked.
+class SqliteReport:
+    def __init__(self, reportFile, timeout=600):
+        self.reportFile = reportFile
+        self.timeout = timeout
+
+    def connect(self):
+        conn = sqlite3.connect(self.reportFile, timeout=self.timeout, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'CREATE TABLE IF NOT EXISTS {tableName} (obsid {columnType("obsid")})')
+        conn.execute(f'CREATE TABLE IF NOT EXISTS {summaryTable} (key TEXT PRIMARY KEY, count INTEGER)')
+        return conn
+
+    def columns(self, conn):
+        return [row[1] for row in conn.execute(f'PRAGMA table_info({tableName})')]
+
+    # Add any columns not already in the table.
+    def addColumns(self, conn, columns):
+        existing = set(self.columns(conn))
+        for col in columns:
+            if col not in existing:
+                conn.execute(f'ALTER TABLE {tableName} ADD COLUMN {quote(col)} {columnType(col)}')
+                existing.add(col)
+
+    # Columns of the report table used for the status summary.
+    def summaryColumns(self, conn):
+        existing = self.columns(conn)
+        return [col for col in ['status', 'job_status', 'jobid'] if col in existing]
+
+    # Summary key for an observation, None if it is not in the report.
+    def obsKey(self, conn, obsid, cols):
+        row = conn.execute(f'SELECT {", ".join(["obsid"] + cols)} FROM {tableName} WHERE obsid = ?', [obsid]).fetchone()
+        if row is None:
+            return None
+        return reportSummary.rowKey(dict(zip(cols, row[1:])))
+
+    # Count the observations in the report table for each summary key.
+    def buildCounts(self, conn):
+        cols = self.summaryColumns(conn)
+        counts = {}
+        for row in conn.execute(f'SELECT {", ".join(["obsid"] + cols)} FROM {tableName}'):
+            key = reportSummary.rowKey(dict(zip(cols, row[1:])))
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    # Read the summary counts, None if the summary has not been created for this report yet.
+    def readCounts(self, conn):
+        counts = {tuple(json.loads(key)): count for key, count in conn.execute(f'SELECT key, count FROM {summaryTable}')}
+        if len(counts) == 0 and conn.execute(f'SELECT EXISTS(SELECT 1 FROM {tableName})').fetchone()[0]:
+            return None
+        return counts
+
+    def writeCounts(self, conn, counts):
+        conn.execute(f'DELETE FROM {summaryTable}')
+        conn.executemany(f'INSERT INTO {summaryTable} (key, count) VALUES (?, ?)', [(json.dumps(list(key)), count) for key, count in counts.items()])
+
+    # Counts of observations by status, job_status and jobid, rebuilt from the report if missing.
+    def summary(self, refresh=False):
+        conn = self.connect()
+        try:
+            counts = None
+            if not refresh:
+                counts = self.readCounts(conn)
+            if counts is None:
+                conn.execute('BEGIN IMMEDIATE')
+                counts = self.buildCounts(conn)
+                self.writeCounts(conn, counts)
+                conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        return counts
+
+    # Read the report into a dataframe matching the layout of the CSV report.
+    def read(self):
+        conn = self.connect()
+        try:
+            cursor = conn.execute(f'SELECT * FROM {tableName}')
+            cols = [desc[0] for desc in cursor.description]
+            rows = cursor.fetchall()
+        finally:
+            conn.close()
+        # Keep the values as python objects so integer columns with missing values are not converted to floats.
+        report = pd.DataFrame(rows, columns=cols, dtype=object)
+        report.set_index('obsid', inplace=True)
+        for col in report.columns:
+            report[col] = report[col].map(toStr)
+        return report
+
+    # Insert or update the values for a single obsid in one transaction.
+    def update(self, obsid, values):
+        return self.updateRows({obsid: values})
+
+    # Insert or update the values for many observations, {obsid: {column: val}}, in one transaction.
+    def updateRows(self, updates):
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            self.addColumns(conn, dict.fromkeys(col for values in updates.values() for col in values))
+            keyCols = self.summaryColumns(conn)
+            counts = self.readCounts(conn)
+            if counts is None:
+                counts = self.buildCounts(conn)
+            for obsid, values in updates.items():
+                if len(values) == 0:
+                    continue
+                oldKey = self.obsKey(conn, obsid, keyCols)
+                cols = list(values.keys())
+                colSql = ', '.join(quote(col) for col in cols)
+                placeholders = ', '.join('?' for col in cols)
+                setSql = ', '.join(f'{quote(col)} = excluded.{quote(col)}' for col in cols)
+                sql = f'INSERT INTO {tableName} (obsid, {colSql}) VALUES (?, {placeholders}) ON CONFLICT(obsid) DO UPDATE SET {setSql}'
+                conn.execute(sql, [obsid] + [toSql(values[col]) for col in cols])
+                # Update the status summary in the same transaction.
+                reportSummary.applyChange(counts, oldKey, self.obsKey(conn, obsid, keyCols))
+            self.writeCounts(conn, counts)
+            conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        return True
+
+    # Replace the entire contents of the report with the dataframe, used to import a CSV report.
+    def write(self, report):
+        cols = [str(col) for col in report.columns]
+        colSql = ', '.join(['obsid'] + [quote(col) for col in cols])
+        placeholders = ', '.join(['?'] * (len(cols) + 1))
+        rows = []
+        for obsid, row in zip(report.index, report.values.tolist()):
+            rows.append([str(obsid)] + [None if pd.isna(val) else toSql(val) for val in row])
+
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(f'DROP TABLE IF EXISTS {tableName}')
+            conn.execute(f'CREATE TABLE {tableName} (obsid {columnType("obsid")})')
+            self.addColumns(conn, cols)
+            conn.executemany(f'INSERT INTO {tableName} ({colSql}) VALUES ({placeholders})', rows)
+            self.writeCounts(conn, self.buildCounts(conn))
+            conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
@@ -0,0 +1,84 @@
+import os
+import json
+import pandas as pd
+
+# Summary index of the report used by manageReport.py status.
+# Observations are counted by (status, job_status, has jobid), which is enough to produce every status count.
+# The counts are updated incrementally by each write so the status does not need to read the whole report.
+
+
+# Normalise a report value so missing and empty values are counted together.
+def normalise(val):
+    if val is None or (isinstance(val, float) and pd.isna(val)) or val == '':
+        return None
+    return str(val)
+
+# Summary key for an observation from its report values.
+def rowKey(values):
+    return (normalise(values.get('status')), normalise(values.get('job_status')), normalise(values.get('jobid')) is not None)
+
+# Count the observations in the report for each key.
+def buildCounts(reportDF):
+    counts = {}
+    for values in reportDF.reindex(columns=['status', 'job_status', 'jobid']).to_dict('records'):
+        key = rowKey(values)
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+# Move an observation from one key to another, oldKey is None for a new observation.
+def applyChange(counts, oldKey, newKey):
+    if oldKey == newKey:
+        return
+    if oldKey is not None:
+        counts[oldKey] = counts.get(oldKey, 0) - 1
+        if counts[oldKey] <= 0:
+            del counts[oldKey]
+    counts[newKey] = counts.get(newKey, 0) + 1
+
+
+# Summary for a CSV report, stored as JSON next to it with the size and modification time of the report it describes.
+def summaryFile(reportFile):
+    return os.path.splitext(reportFile)[0] + '.summary.json'
+
+def writeSummary(reportFile, counts):
+    stat = os.stat(reportFile)
+    summary = dict(reportMtime=stat.st_mtime_ns, reportSize=stat.st_size, counts=[list(key) + [count] for key, count in counts.items()])
+    file = summaryFile(reportFile)
+    with open(file + '.tmp', 'w') as f:
+        json.dump(summary, f)
+    os.replace(file + '.tmp', file)
+
+# Return the counts if the summary matches the current report, otherwise None.
+def readSummary(reportFile):
+    file = summaryFile(reportFile)
+    if not os.path.exists(file):
+        return None
+    try:
+        with open(file, 'r') as f:
+            summary = json.load(f)
+    except (OSError, ValueError):
+        return None
+    stat = os.stat(reportFile)
+    if summary['reportMtime'] != stat.st_mtime_ns or summary['reportSize'] != stat.st_size:
+        return None
+    return {(status, jobStatus, hasJobid): count for status, jobStatus, hasJobid, count in summary['counts']}
+
+
+# Convert the counts into the figures reported by manageReport.py status.
+def statusCounts(counts):
+    def total(match):
+        return sum(count for key, count in counts.items() if match(*key))
+
+    return dict(
+        totalObs = total(lambda status, jobStatus, hasJobid: True),
+        jobsNotDownloaded = total(lambda status, jobStatus, hasJobid: not hasJobid),
+        jobsSubmitted = total(lambda status, jobStatus, hasJobid: jobStatus is not None and jobStatus not in ('Downloaded', 'Purged', 'Missing Data')),
+        jobsErrors = total(lambda status, jobStatus, hasJobid: jobStatus == 'Missing Data'),
+        jobsDownloaded = total(lambda status, jobStatus, hasJobid: jobStatus in ('Downloaded', 'Purged')),
+        obsProcessed = total(lambda status, jobStatus, hasJobid: status is not None),
+        obsQueued = total(lambda status, jobStatus, hasJobid: status == 'Queued'),
+        obsFailed = total(lambda status, jobStatus, hasJobid: status == 'Failed'),
+        obsMissing = total(lambda status, jobStatus, hasJobid: status == 'Missing Data'),
+        obsReady = total(lambda status, jobStatus, hasJobid: status not in ('Success', 'Failed') and jobStatus == 'Downloaded'),
+        obsSuccess = total(lambda status, jobStatus, hasJobid: status == 'Success'),
+    )
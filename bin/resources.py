@@ -0,0 +1,121 @@
+import os
+
+# Cores and memory allocated to the task, used to set the thread and memory options of the external tools run by
+# calibrate.py, image.py and postImage.py so they match the Nextflow/Slurm allocation rather than the node.
+# The allocation is the smallest of the CPU affinity, the Slurm environment and the cgroup limits of the process,
+# and can be overridden with the DIP_CORES and DIP_MEMORY (GB) environment variables.
+
+cgroupRoot = '/sys/fs/cgroup'
+# Environment variables read by the threaded libraries (OpenMP, BLAS, numexpr) used by the tools.
+threadVariables = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+def readValue(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+# Directories of the cgroup of the process for a controller, from the process's own cgroup up to the root,
+# as limits may be set on any of them (e.g. the Slurm job rather than the step).
+def cgroupDirs(controller):
+    lines = readValue('/proc/self/cgroup')
+    if lines is None:
+        return []
+    for line in lines.splitlines():
+        hierarchy, controllers, path = line.split(':', 2)
+        if hierarchy == '0' and os.path.exists(os.path.join(cgroupRoot, 'cgroup.controllers')):
+            base = cgroupRoot
+        elif controller in controllers.split(','):
+            base = os.path.join(cgroupRoot, controllers)
+            if not os.path.isdir(base):
+                base = os.path.join(cgroupRoot, controller)
+        else:
+            continue
+        dirs = []
+        path = path.strip('/')
+        while path:
+            dirs.append(os.path.join(base, path))
+            path = os.path.dirname(path)
+        # Inside a container the cgroup of the process is usually mounted as the root.
+        dirs.append(base)
+        return [d for d in dirs if os.path.isdir(d)]
+    return []
+
+
+# Number of cores from the cgroup CPU quota, cpu.max (v2) or cpu.cfs_quota_us and cpu.cfs_period_us (v1).
+def cgroupCores():
+    limits = []
+    for d in cgroupDirs('cpu'):
+        quota = readValue(os.path.join(d, 'cpu.max'))
+        if quota is not None:
+            quota, _, period = quota.partition(' ')
+        else:
+            quota = readValue(os.path.join(d, 'cpu.cfs_quota_us'))
+            period = readValue(os.path.join(d, 'cpu.cfs_period_us'))
+        try:
+            if quota not in (None, 'max', '-1'):
+                limits.append(max(1, int(int(quota) / int(period))))
+        except (ValueError, ZeroDivisionError):
+            pass
+    return min(limits, default=None)
+
+# Memory limit in bytes from the cgroup, memory.max (v2) or memory.limit_in_bytes (v1).
+def cgroupMemory():
+    limits = []
+    for d in cgroupDirs('memory'):
+        limit = readValue(os.path.join(d, 'memory.max'))
+        if limit is None:
+            limit = readValue(os.path.join(d, 'memory.limit_in_bytes'))
+        try:
+            if limit not in (None, 'max'):
+                limits.append(int(limit))
+        except ValueError:
+            pass
+    return min(limits, default=None)
+
+
+def envInt(name):
+    try:
+        return int(os.environ[name])
+    except (KeyError, ValueError):
+        return None
+
+
+# Number of cores the task can use.
+def availableCores():
+    if envInt('DIP_CORES'):
+        return envInt('DIP_CORES')
+
+    limits = [len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1]
+    if envInt('SLURM_CPUS_PER_TASK'):
+        limits.append(envInt('SLURM_CPUS_PER_TASK'))
+    if cgroupCores():
+        limits.append(cgroupCores())
+    return max(1, min(limits))
+
+# Memory in GB the task can use, the fraction leaves room for the python script and the tool's own overheads.
+def availableMemory(fraction=0.9):
+    if envInt('DIP_MEMORY'):
+        return envInt('DIP_MEMORY')
+
+    limits = [os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')]
+    # Slurm gives the memory in MB, either per node or per core.
+    if envInt('SLURM_MEM_PER_NODE'):
+        limits.append(envInt('SLURM_MEM_PER_NODE') * 1024**2)
+    elif envInt('SLURM_MEM_PER_CPU'):
+        limits.append(envInt('SLURM_MEM_PER_CPU') * 1024**2 * availableCores())
+    if cgroupMemory():
+        limits.append(cgroupMemory())
+    return max(1, int(min(limits) * fraction / 1024**3))
+
+
+# Limit the threads of the libraries used by the tools to the allocated cores.
+# Tools without a thread option inherit the limits from the environment.
+def limitThreads():
+    cores = str(availableCores())
+    for name in threadVariables:
+        os.environ[name] = cores
+    return int(cores)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Scratch space management for the ASVO deliveries and observation directories, used by manageReport.py.
+# Directories are removed by renaming them into a trash directory on the same filesystem, which is instant, and the
+# trash is deleted in parallel by a background process so manageReport.py does not wait for the deletions.
+# Usage: scratchManager.py trashDir [trashDir ...] to delete the contents of the trash directories.
+
+trashName = '.dip_trash'
+workers = 8
+# Size assumed for an observation before any downloads have been measured.
+defaultObsBytes = 20 * 1024**3
+sizeUnits = dict(K=1024, M=1024**2, G=1024**3, T=1024**4, P=1024**5)
+
+
+# Convert a size such as 500G or 20T to bytes.
+def parseSize(size):
+    size = size.strip().upper().rstrip('B')
+    if size[-1:] in sizeUnits:
+        return int(float(size[:-1]) * sizeUnits[size[-1]])
+    return int(float(size))
+
+def formatSize(size):
+    for unit in ['P', 'T', 'G', 'M', 'K']:
+        if size >= sizeUnits[unit]:
+            return f'{size / sizeUnits[unit]:.1f}{unit}'
+    return f'{size}B'
+
+
+# Total size of the files under a path, without following symlinks.
+def pathBytes(path):
+    if os.path.islink(path) or not os.path.isdir(path):
+        return os.lstat(path).st_size if os.path.lexists(path) else 0
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            total += os.lstat(os.path.join(root, name)).st_size
+    return total
+
+# Size of each ASVO job directory, {jobid: bytes}, measured in parallel.
+def jobBytes(asvoPath, jobids):
+    jobids = list(dict.fromkeys(str(jobid) for jobid in jobids))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        sizes = pool.map(lambda jobid: pathBytes(os.path.join(asvoPath, jobid)), jobids)
+    return dict(zip(jobids, sizes))
+
+
+# Number of observations which can be downloaded without the scratch usage going over the quota,
+# allowing for the jobs already in flight.
+def admit(numberObs, usedBytes, inFlight, quota, obsBytes):
+    available = quota - usedBytes - inFlight * obsBytes
+    return max(0, min(numberObs, int(available // obsBytes)))
+
+
+# Move a directory or symlink into the trash directory next to it and return the trash directory.
+def moveToTrash(path):
+    trash = os.path.join(os.path.dirname(os.path.normpath(path)), trashName)
+    os.makedirs(trash, exist_ok=True)
+    os.rename(path, os.path.join(trash, f'{os.path.basename(os.path.normpath(path))}.{time.time_ns()}'))
+    return trash
+
+
+def deleteEntry(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+# Delete the contents of the trash directories in parallel.
+def emptyTrash(trashDirs):
+    paths = [os.path.join(trash, name) for trash in trashDirs if os.path.isdir(trash) for name in os.listdir(trash)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(deleteEntry, paths))
+    return len(paths)
+
+# Empty the trash directories in a detached process which carries on after manageReport.py exits.
+def emptyTrashInBackground(trashDirs):
+    trashDirs = sorted(set(trashDirs))
+    if len(trashDirs) == 0:
+        return
+    subprocess.Popen([sys.executable, os.path.abspath(__file__)] + trashDirs, start_new_session=True,
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('ERROR: Incorrect number of parameters.')
+        exit(-1)
+
+    count = emptyTrash(sys.argv[1:])
+    print(f'Deleted {count} entries.')
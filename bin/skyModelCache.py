@@ -0,0 +1,70 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+# Shared cache of the calibration sky models built by calibrate.py.
+# Observations with the same pointing (RA, DEC, GRIDNUM, DELAYS), frequency (CENTCHAN) and cropping parameters
+# give the same model from the same catalogue, so the model is built once and reused.
+# Each entry is a directory named by the hash of its key, written to a temporary directory and renamed into place
+# so tasks writing the same entry at the same time never see a partial entry.
+cacheVersion = 1
+keyHeaders = ('RA', 'DEC', 'GRIDNUM', 'DELAYS', 'CENTCHAN')
+
+
+# Hash of the contents of a file.
+def fileHash(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+# Key for the model of an observation from its metafits header, the cropping parameters and the catalogue contents.
+def cacheKey(metadata, radius, topBright, catalogue):
+    key = {header: str(metadata[header]) for header in keyHeaders}
+    key.update(radius=radius, top_bright=topBright, catalogue=fileHash(catalogue), version=cacheVersion)
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+# Copy the cached files, {cached name: destination}, into place, returning False if the entry is not cached.
+def fetch(cacheDir, key, files):
+    entry = os.path.join(cacheDir, key)
+    if not all(os.path.exists(os.path.join(entry, name)) for name in files):
+        return False
+    # The files are small, so they are copied rather than linked to keep the cache safe from changes to the task's copy.
+    for name, dst in files.items():
+        shutil.copyfile(os.path.join(entry, name), dst)
+    return True
+
+
+# Add the files, {cached name: source}, to the cache.
+# If another task has already stored the entry its copy is kept, only adding any files it is missing.
+def store(cacheDir, key, files):
+    if not all(os.path.exists(src) for src in files.values()):
+        return False
+    os.makedirs(cacheDir, exist_ok=True)
+    entry = os.path.join(cacheDir, key)
+    if os.path.exists(entry):
+        for name, src in files.items():
+            dst = os.path.join(entry, name)
+            if not os.path.exists(dst):
+                fd, tmpFile = tempfile.mkstemp(prefix=f'.{name}.', dir=entry)
+                os.close(fd)
+                shutil.copyfile(src, tmpFile)
+                os.chmod(tmpFile, 0o644)
+                os.replace(tmpFile, dst)
+        return True
+
+    tmpEntry = tempfile.mkdtemp(prefix=f'.{key}.', dir=cacheDir)
+    os.chmod(tmpEntry, 0o755)
+    try:
+        for name, src in files.items():
+            shutil.copyfile(src, os.path.join(tmpEntry, name))
+        os.rename(tmpEntry, entry)
+    except OSError:
+        # The entry was stored by another task first.
+        shutil.rmtree(tmpEntry, ignore_errors=True)
+    return True
@@ -0,0 +1,42 @@
+import time
+import resource
+import datetime
+
+# Suffixes of the report columns recorded for each stage.
+timingColumns = ('_start', '_end', '_wall_s', '_cpu_s', '_maxrss_mb')
+
+
+# CPU time used so far by this process and all of the external tools it has run and waited for.
+def cpuTime():
+    usageSelf = resource.getrusage(resource.RUSAGE_SELF)
+    usageChildren = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usageSelf.ru_utime + usageSelf.ru_stime + usageChildren.ru_utime + usageChildren.ru_stime
+
+# Peak resident memory in MB of this process or the largest of the external tools it has run.
+def maxRss():
+    usageSelf = resource.getrusage(resource.RUSAGE_SELF)
+    usageChildren = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kilobytes on Linux.
+    return max(usageSelf.ru_maxrss, usageChildren.ru_maxrss) / 1024
+
+def timestamp(epoch):
+    return datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc).isoformat(timespec='seconds')
+
+
+# Record the start, end, wall time, CPU time and peak memory of a processing stage.
+class StageTimer:
+    def __init__(self, stage):
+        self.stage = stage
+        self.start = time.time()
+        self.startWall = time.monotonic()
+        self.startCpu = cpuTime()
+
+    # Return the report columns for the stage up to now.
+    def stop(self):
+        return {
+            f'{self.stage}_start': timestamp(self.start),
+            f'{self.stage}_end': timestamp(time.time()),
+            f'{self.stage}_wall_s': round(time.monotonic() - self.startWall, 1),
+            f'{self.stage}_cpu_s': round(cpuTime() - self.startCpu, 1),
+            f'{self.stage}_maxrss_mb': round(maxRss(), 1),
+        }
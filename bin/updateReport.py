@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 
+import os
 import sys
-import report
+import reportClient
 
 
 if len(sys.argv) != 5:
@@ -13,4 +14,13 @@ obsid = sys.argv[2]
 action = sys.argv[3]
 val = sys.argv[4]
 
+# Send the update to the report server if one is running, this avoids loading pandas and the report.
+serverAddress = reportClient.serverAddress()
+if serverAddress != '' and reportClient.updateObsMany(serverAddress, reportCsv, obsid, {action: val}):
+    print(f'Updating Report - ObsID: {obsid[0:10]} - Action: {action} - Value: {val}')
+    exit()
+
+# Server unavailable or not configured, update the report file directly.
+os.environ.pop(reportClient.serverEnv, None)
+import report
 report.updateObs(reportCsv, obsid, action, val)
@@ -94,6 +94,12 @@ workflow {
   // Only process the symbolic links.
   obsDirFull = params.obsdir + '/*'
   obsDirCh = Channel.fromPath(obsDirFull, type: 'dir').filter{java.nio.file.Files.isSymbolicLink(it)}
+  // In streaming mode also process the symlinks created by "manageReport.py stream" as the downloads complete,
+  // until it writes the done file.
+  if (params.stream && !file(params.obsdir + '/DIP_STREAM_DONE').exists()) {
+    newObsCh = Channel.watchPath(obsDirFull, 'create').until{ it.name == 'DIP_STREAM_DONE' }.filter{java.nio.file.Files.isSymbolicLink(it)}
+    obsDirCh = obsDirCh.mix(newObsCh)
+  }
   subChans = Channel.of('0000', '0001', '0002', '0003', 'MFS')
 
   